@@ -4,8 +4,16 @@ import os
 import cv2
 import sys
 import json
+import math
+import mmap
+import queue
+import time
 import shutil
+import resource
 import argparse
+import contextlib
+import threading
+import multiprocessing
 import datetime
 import subprocess
 import numpy as np
@@ -17,11 +25,57 @@ cutout = ''
 filePermissions = '755'
 validFormats = ['.ts','.mkv','.mp4','.avi']
 htsLogFiles = '/home/hts/.hts/tvheadend/dvr/log/'
+refLibrary = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'refImages')	# reference frames, one folder per service_name (FROM_*.jpg, TO_*.jpg, optional *.mask.png and regions.json)
+signatureSize = (64, 36)		# (width, height) of the luma signatures compared by the frame matcher
+coarseStep = 5				# seconds between samples in the coarse pass of the frame matcher
+diffMinFROM = 3.0			# max. mean absolute luma difference (0-255) for a frame to match the FROM reference
+diffMinTO = 3.0				# max. mean absolute luma difference (0-255) for a frame to match the TO reference
+abandonRows = 4				# signature rows summed between early-abandonment checks of the frame matcher
+skipAfterFROM = 3000 * 45		# frames skipped after the FROM match, before looking for TO
+matchBatch = 64				# sampled frames compared to the references in one broadcast by the pool workers
+ringSlots = 8				# frames in a reader's ring buffer: a yielded frame stays valid until this many more are read
+tsProbeBytes = 8 * 2**20		# bytes at the start of a .ts recording searched for its PAT, PMT and SDT
+languageCodes = {'dan' : 'da', 'swe' : 'sv', 'nor' : 'no', 'nob' : 'nb', 'nno' : 'nn', 'fin' : 'fi', 'eng' : 'en', 'ger' : 'de', 'deu' : 'de', 'fre' : 'fr', 'fra' : 'fr', 'dut' : 'nl', 'nld' : 'nl', 'ita' : 'it', 'spa' : 'es', 'isl' : 'is', 'ice' : 'is'}	# ISO 639-2 codes of the PMT, as the 2-letter codes MediaInfo reports
+tsScanPackets = 2**18			# packets (48 MB) checked per block by the stream integrity scanner
+pcrMaxGap = 0.1				# seconds between two PCRs above which the stream counts as interrupted
+tsMaxErrors = 10			# errors in any minute above which a recording is considered broken
+benchmarkSeconds = 120			# seconds of video decoded by each backend in --benchmarkDecoders
+dvrMargin = 5 * 60			# seconds searched on each side of the programme start/stop from the tvheadend DVR log
+gapWindow = 0.2			# seconds of audio and video per window of the black/silence detector
+gapRate = 4000			# Hz, sample rate the audio is decoded to for the black/silence detector
+blackLevel = 32			# mean luma (0-255) of the downscaled frame below which a window is black
+silenceLevel = -50		# RMS in dBFS below which a window is silent
+gapMin = 0.4			# seconds, shortest black and silent gap reported
+jingleRate = 8000		# Hz, sample rate audio is decoded to for jingle fingerprints
+jingleFFT = 512			# samples per STFT frame of the jingle fingerprints
+jingleHop = 256			# samples between STFT frames (32 ms at 8 kHz)
+jinglePeaks = 5			# strongest spectral peaks kept per STFT frame
+jingleMinScore = 0.5		# fraction of the peaks of a jingle that must be found in the recording for a match
+subtitleGap = 5 * 60		# seconds without subtitle cues that split them into separate clusters
+subtitleMinCues = 20		# fewest cues a subtitle hint is made from
+subtitlePad = 10		# seconds added before the first and after the last cue of the programme
+subtitleMargin = 3 * 60		# seconds searched on each side of the subtitle span by --findStopEnd
+subtitleConfidence = 0.95	# confidence in both ends of the subtitle span above which frame matching is skipped (0.95 : 15 s from the DVR schedule)
+logoBox = [0.78, 0.03, 0.97, 0.17]	# corner (fractions left, top, right, bottom) holding the channel logo, unless logo.json of the service says otherwise
+logoSize = (96, 48)		# size the logo corner is scaled to after cropping
+logoLearnStep = 10		# seconds between the frames a logo template is learned from
+logoStable = 0.25		# share of the corner pixels, the most stable ones, that make up the logo mask
+logoMinScore = 0.5		# correlation with the template above which the logo is present
+adMinLength = 60		# seconds without logo reported as an ad break
+sceneSize = (64, 36)		# size frames are scaled to before their histograms are compared
+sceneBins = 32			# luma histogram bins of the scene-change detector
+sceneThreshold = 0.5		# histogram change (L1 distance, 0-2) between consecutive frames that makes a shot boundary
+sceneSaveEvery = 10 * 60	# seconds of video between saves of the scene index, so an interrupted scan can be continued
+hashMaxDistance = 10			# max. differing bits (of 64) for a hash index entry to match a reference
 extJobs = 		{		1    : "ccextractor -o '%s' -tpage %s '%s'",     # (outputFile, textTV_page, inputFile)
 					2    : "HandBrakeCLI -e x264  -q 23.0 --loose-anamorphic --x264-preset veryfast --h264-profile main --h264-level 4.0%s -o '%s' -i '%s' %s",     # (Srt-file, Outputfile, Inputfile)
 					2.1  : " --srt-default --srt-codeset UTF-8",
 					2.11 : " --subtitle %s --srt-file '%s' --srt-lang '%s'",
-					2.2  : "--start-at duration:%d --stop-at duration:%d",
+					2.2  : "--start-at pts:%d --stop-at pts:%d",
+					2.3  : "mkvmerge -q -o '%s' --split parts:%s '%s'",	# (Outputfile with %d for the part number, kept ranges 'a-b,+c-d', Inputfile)
+					2.4  : "ffmpeg -nostdin -v error -ss %s -to %s -i '%s' -map 0 -c copy -y '%s'",	# (from, to, Inputfile, Outputfile) one kept range, when mkvmerge is missing
+					2.5  : "printf \"file '%%s'\\n\" %s > '%s'",	# (quoted range files, list of ranges)
+					2.6  : "ffmpeg -nostdin -v error -f concat -safe 0 -i '%s' -map 0 -c copy -y '%s'",	# (list of ranges, Outputfile)
 #					3    : "ffmpeg -i '%s' -i '%s' -map 0 -map 1 -c copy -metadata:s:s:0 language=eng -disposition:s:0 default '%s'",	# (Inputfile, Srt-file, Outputfile)
 					3    : "ffmpeg -i '%s'%s -map 0%s -c copy%s -disposition:s:0 default '%s'",	# (Inputfile, 3.1, 3.2, 3.3, Outputfile)
 					3.1  : " -i '%s'",
@@ -51,6 +105,7 @@ class fileClass:
 	fullOutFile = None
 	subLang = None
 	service = None
+	subtitleSpan = None	# (start, stop) seconds of the programme estimated from its subtitles
 
 	def __init__(self, fn):
 		self.fullPath = os.path.abspath(fn)
@@ -62,6 +117,30 @@ class fileClass:
 			self.outFile = self.outFile.replace(' ', '.')
 		self.srtFiles = []
 
+	def sidecar(self, suffix):
+		""" Returns the path of a sidecar file stored next to the recording """
+		return os.path.join(self.path, self.noExt + suffix)
+
+	def stamp(self):
+		""" Returns size, mtime and inode of the recording, used to invalidate sidecars when it changes or is replaced """
+		info = os.stat(self.fullPath)
+		return {'size' : info.st_size, 'mtime' : info.st_mtime, 'inode' : info.st_ino}
+
+	def checkMedia(self):
+		""" Reads service name and subtitle language of the recording, from its transport stream tables or else with MediaInfo """
+		probe = probeTS(self.fullPath) if self.ext == '.ts' else None
+		if probe and probe['service']:
+			self.subLang = probe['subLang'] or False
+			self.service = probe['service']
+			return
+		mediaInfo = {}
+		fileInfo = json.loads(MediaInfo.parse(self.fullPath).to_json())
+		for track in fileInfo['tracks']:
+			mediaInfo[track['track_type']] = track
+		# cherrypick info
+		self.subLang = mediaInfo['Other']['language']    if 'Other' in mediaInfo else False
+		self.service = mediaInfo['Menu']['service_name'] if 'Menu' in mediaInfo else False
+
 	def checkSrt(self):
 		for f in os.listdir(self.path):
 			filename, ext = os.path.splitext(f)
@@ -72,10 +151,264 @@ class fileClass:
 				self.srtFiles.append([f, language])	# f should be absolute, but abs() does not work
 
 
+class frameSource:
+	""" Base of the decoder backends: gives access to the frames of a recording by frame number """
+
+	name = None
+	fps = None
+	frameCount = None
+	gray = False		# yield luma (Y-plane) views from a ring buffer instead of BGR images
+
+	def __init__(self, fileName):
+		self.fileName = fileName
+
+	def frames(self, start, stop, step):
+		""" Yields (frameNumber, image) for every step'th frame from start to stop """
+		raise NotImplementedError
+
+	def frame(self, frameNo):
+		""" Returns the image of a single frame, or None if it can not be decoded """
+		return next(self.frames(frameNo, frameNo + 1, 1), (None, None))[1]
+
+	def release(self):
+		pass
+
+
+class openCVSource(frameSource):
+	""" Frames decoded by cv2.VideoCapture, either seeking to each sample or walking the file forward (grab/retrieve) """
+
+	name = 'opencv'
+
+	def __init__(self, fileName, sequential=True):
+		self.fileName = fileName
+		self.sequential = sequential
+		self.cap = cv2.VideoCapture(fileName)
+		self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+		self.frameCount = self.cap.get(cv2.CAP_PROP_FRAME_COUNT)
+
+	def frames(self, start, stop, step):
+		reader = grabFrames if self.sequential else seekFrames
+		if not self.gray:
+			return reader(self.cap, start, stop, step)
+		return self.lumaFrames(reader(self.cap, start, stop, step))
+
+	def lumaFrames(self, frames):
+		""" Converts the decoded frames to gray, directly into the slots of a ring buffer """
+		ring = None
+		for count, (frameNo, img) in enumerate(frames):
+			if ring is None:
+				ring = np.empty((ringSlots,) + img.shape[:2], dtype=np.uint8)
+			yield frameNo, cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=ring[count % ringSlots])
+
+	def release(self):
+		self.cap.release()
+
+
+class ffmpegSource(frameSource):
+	""" Frames decoded by an ffmpeg subprocess, piped as raw BGR (or gray) video into a ring buffer """
+
+	name = 'ffmpeg'
+
+	def __init__(self, fileName):
+		self.fileName = fileName
+		self.fps, self.frameCount, self.width, self.height = probeVideo(fileName)
+
+	def frames(self, start, stop, step):
+		shape = (self.height, self.width) if self.gray else (self.height, self.width, 3)
+		cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-ss', '%.3f' % (start / self.fps), '-i', self.fileName, '-an', '-sn', '-vsync', 'passthrough',
+			'-vf', 'select=not(mod(n\\,%d))' % step, '-frames:v', str(-(-int(stop - start) // step)),
+			'-pix_fmt', 'gray' if self.gray else 'bgr24', '-f', 'rawvideo', '-']
+		process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+		try:
+			for frameNo, img in zip(range(int(start), int(stop), step), readFrames(process.stdout, shape)):
+				yield frameNo, img
+		finally:
+			process.kill()
+			process.wait()
+
+
+class pyAVSource(frameSource):
+	""" Frames decoded in-process by PyAV (optional, "pip3 install av") """
+
+	name = 'pyav'
+
+	def __init__(self, fileName):
+		try:
+			import av
+		except ImportError:
+			sys.exit('\n  PyAV does not seem to be installed. Install with "pip3 install av"\n')
+		self.fileName = fileName
+		self.container = av.open(fileName)
+		self.stream = self.container.streams.video[0]
+		self.stream.thread_type = 'AUTO'
+		self.fps = float(self.stream.average_rate)
+		self.frameCount = self.stream.frames or float(self.container.duration) / 1000000 * self.fps
+
+	def frames(self, start, stop, step):
+		""" In gray mode the decoder's own Y-plane is used: full-range luma is yielded as a view, limited-range luma is expanded into a ring buffer """
+		startTime = self.stream.start_time or 0
+		self.container.seek(startTime + int(start / self.fps / self.stream.time_base), stream=self.stream)	# lands on the keyframe before start
+		ring = None
+		count = 0
+		for frame in self.container.decode(self.stream):
+			frameNo = int(round((frame.pts - startTime) * self.stream.time_base * self.fps))
+			if frameNo >= stop:
+				return
+			if frameNo >= start and (frameNo - start) % step == 0:
+				if not self.gray:
+					yield frameNo, frame.to_ndarray(format='bgr24')
+				elif frame.format.name in ('yuvj420p', 'yuvj422p', 'yuvj444p', 'gray'):
+					yield frameNo, self.lumaPlane(frame)
+				elif frame.format.name in ('yuv420p', 'yuv422p', 'yuv444p'):
+					if ring is None:
+						ring = np.empty((ringSlots, frame.height, frame.width), dtype=np.uint8)
+					count += 1
+					yield frameNo, cv2.convertScaleAbs(self.lumaPlane(frame), dst=ring[count % ringSlots], alpha=255 / 219.0, beta=-16 * 255 / 219.0)
+				else:
+					yield frameNo, frame.to_ndarray(format='gray')
+
+	def lumaPlane(self, frame):
+		""" Returns the Y-plane of a planar YUV frame as a view of the decoder's buffer """
+		plane = frame.planes[0]
+		return np.frombuffer(plane, dtype=np.uint8).reshape(-1, plane.line_size)[:frame.height, :frame.width]
+
+	def release(self):
+		self.container.close()
+
+
+frameSources = {'opencv' : openCVSource, 'ffmpeg' : ffmpegSource, 'pyav' : pyAVSource}
+
+
+class analyzer:
+	""" Base of the analyses run by analyzeRecording, which decodes the recording once and hands every analyzer the
+	    (gray) frames on its own grid. Frames are ring buffer slots, so state kept between frames must be bounded copies """
+
+	name = None
+	seconds = 1		# seconds between the frames analysed
+	start = 0		# first frame wanted (an analyzer continuing earlier work starts later)
+
+	def __init__(self, fh, fps, frameCount):
+		self.fh = fh
+		self.fps = fps
+		self.frameCount = frameCount
+		self.step = max(int(self.seconds * fps), 1)
+
+	def frame(self, frameNo, img):
+		pass
+
+	def finish(self):
+		""" Returns the results, once the pipeline has decoded the whole recording """
+		return None
+
+	def report(self, results):
+		print('    %-10s : %s' % (self.name, results))
+
+
+class referenceAnalyzer(analyzer):
+	""" Frames matching the FROM and TO references of the service, refined frame by frame when the pipeline finishes """
+
+	name = 'references'
+
+	def __init__(self, fh, fps, frameCount):
+		self.seconds = float(args.coarseStep[0]) if args.coarseStep else coarseStep
+		analyzer.__init__(self, fh, fps, frameCount)
+		self.sigSize = parseSize(args.signatureSize[0]) if args.signatureSize else signatureSize
+		self.refs = loadReferences(fh.service, self.sigSize)
+		self.searchEnd = int(frameCount - fps)
+		self.windowFROM, self.windowTO = searchWindows(fh, fps, self.searchEnd)
+		self.matches = {}		# kind : (frameNumber, reference) of the first coarse match
+
+	def frame(self, frameNo, img):
+		if not self.refs or 'TO' in self.matches:
+			return
+		if 'FROM' not in self.matches:
+			kind, limit, window = 'FROM', diffMinFROM, self.windowFROM
+		else:
+			kind, limit, window = 'TO', diffMinTO, windowAfter(self.windowTO, self.matches['FROM'][0], self.searchEnd)
+		if window[0] <= frameNo < window[1]:
+			difference, ref = bestReference(self.refs[kind][1], makeSignature(img, self.sigSize, self.refs['box']), self.refs[kind][3], limit)
+			if difference < limit:
+				self.matches[kind] = (frameNo, ref)
+
+	def finish(self):
+		""" Returns {'FROM' : (timestamp, difference, reference), 'TO' : (...)}, or None """
+		if 'TO' not in self.matches:
+			return None
+		source = openSource(self.fh.fullPath, args.decoder, gray=True)	# refining only seeks a few frames
+		found = {}
+		for kind, (frameNo, ref) in self.matches.items():
+			frameNo, difference = refineMatch(source, self.refs, kind, ref, self.sigSize, frameNo, self.step)
+			found[kind] = (secondsToTime(frameNo / source.fps), difference, self.refs[kind][0][ref])
+		source.release()
+		return found
+
+	def report(self, results):
+		if results:
+			reportCutout(self.fh, results)
+		else:
+			print('    %-10s : %s' % (self.name, 'no match' if self.refs else 'no reference frames'))
+
+
+class hashIndexAnalyzer(analyzer):
+	""" The per-second dHash index used by --useIndex, stored as a sidecar of the recording """
+
+	name = 'index'
+
+	def __init__(self, fh, fps, frameCount):
+		analyzer.__init__(self, fh, fps, frameCount)
+		self.hashes = []
+
+	def frame(self, frameNo, img):
+		self.hashes.append(dHash(img))
+
+	def finish(self):
+		saveHashIndex(self.fh, np.array(self.hashes, dtype=np.uint64), self.fps)
+		return '%d seconds indexed' % len(self.hashes)
+
+
+class sceneAnalyzer(analyzer):
+	""" Shot boundaries, where the luma histogram changes more than sceneThreshold from one frame to the next.
+	    Kept as a sidecar of millisecond timestamps and continued from where the last run stopped, e.g. while the recording grows """
+
+	name = 'scenes'
+	seconds = 0		# every frame
+
+	def __init__(self, fh, fps, frameCount):
+		analyzer.__init__(self, fh, fps, frameCount)
+		index = loadSceneIndex(fh)
+		self.cuts = list(index[0]) if index else []
+		self.start = max(index[1] - 1, 0) if index else 0	# the frame before the first new one gives the histogram to compare with
+		self.scanned = self.saved = self.start
+		self.previous = None
+
+	def frame(self, frameNo, img):
+		small = cv2.resize(img, sceneSize, interpolation=cv2.INTER_AREA)
+		histogram = cv2.calcHist([small], [0], None, [sceneBins], [0, 256]).ravel() / small.size
+		if self.previous is not None and np.abs(histogram - self.previous).sum() > sceneThreshold:
+			self.cuts.append(int(round(frameNo * 1000 / self.fps)))
+		self.previous = histogram
+		self.scanned = frameNo + 1
+		if self.scanned - self.saved >= sceneSaveEvery * self.fps:
+			saveSceneIndex(self.fh, self.cuts, self.scanned)
+			self.saved = self.scanned
+
+	def finish(self):
+		if self.scanned > self.saved or not os.path.exists(self.fh.sidecar('.scenes.npy')):
+			saveSceneIndex(self.fh, self.cuts, self.scanned)
+		return '%d shot boundaries in %s' % (len(self.cuts), secondsToTime(int(self.scanned / self.fps)))
+
+
+analyzers = {'references' : referenceAnalyzer, 'index' : hashIndexAnalyzer, 'scenes' : sceneAnalyzer}
+
+
 # --- Defs ---------------------------------------------------------------------------------------
 
 
 def secondsToTime(secondsIn):
+	""" Formats seconds as hh:mm:ss, or hh:mm:ss.mmm if given fractional seconds """
+	if isinstance(secondsIn, float):
+		seconds, millis = divmod(int(round(secondsIn * 1000)), 1000)
+		return secondsToTime(seconds) + '.%03d' % millis
 	hours, minutes = 0, 0
 	minutes, seconds= divmod(secondsIn, 60)
 	hours, minutes = divmod(minutes, 60)
@@ -87,19 +420,44 @@ def secondsToTime(secondsIn):
 
 def timeToSeconds(timeIn):
 	splitup = timeIn.split(':')
+	seconds = float(splitup[-1]) if '.' in splitup[-1] else int(splitup[-1])	# hh:mm:ss.mmm gives fractional seconds
 	if len(splitup) == 3:
-		return int(splitup[0]) * 3600  + int(splitup[1]) * 60 + int(splitup[2])
+		return int(splitup[0]) * 3600  + int(splitup[1]) * 60 + seconds
 	elif len(splitup) == 2:
-		return int(splitup[0]) * 60 + int(splitup[1])
+		return int(splitup[0]) * 60 + seconds
 	elif len(splitup) == 1:
-		return int(splitup[0])
+		return seconds
+
+
+def parseCutout(raw):
+	""" Returns the (from, to) timemarks of the ranges to keep in a cutout string ('hh:mm:ss,hh:mm:ss[,hh:mm:ss,hh:mm:ss...]') """
+	marks = raw.split(',')
+	if len(marks) < 2 or len(marks) % 2:
+		sys.exit('\nMalformed cutout string: must contain pairs of timemarks, seperated by "," ( e.g. "hh:mm:ss,hh:mm:ss[,hh:mm:ss,hh:mm:ss]")\n')
+	seconds = [timeToSeconds(mark.strip()) for mark in marks]
+	if any(b <= a for a, b in zip(seconds, seconds[1:])):
+		sys.exit('\nMalformed cutout string: timemarks must be increasing\n')
+	return [(marks[n].strip(), marks[n + 1].strip()) for n in range(0, len(marks), 2)]
+
+
+def joinCommands(fh, ranges):
+	""" Returns (commands, joined file, temporary files) that stream copy the kept ranges of the recording into one file,
+	    with a single mkvmerge --split parts: call, or ffmpeg cuts and a concat when mkvmerge is missing """
+	joined = fh.sidecar('.parts.mkv')
+	if shutil.which('mkvmerge'):	# splitting numbers the output files, at %d of the name or else as -001, so the single one is named .parts1.mkv
+		return [extJobs[2.3] % (fh.sidecar('.parts%d.mkv'), ',+'.join('%s-%s' % r for r in ranges), fh.fullPath)], fh.sidecar('.parts1.mkv'), [fh.sidecar('.parts1.mkv')]
+	parts = [fh.sidecar('.part%02d.mkv' % n) for n in range(len(ranges))]
+	listFile = fh.sidecar('.parts.txt')
+	commands = [extJobs[2.4] % (fra, til, fh.fullPath, part) for (fra, til), part in zip(ranges, parts)]
+	commands += [extJobs[2.5] % (' '.join("'%s'" % part for part in parts), listFile), extJobs[2.6] % (listFile, joined)]
+	return commands, joined, parts + [listFile, joined]
 
 
 def calculateCutting(_from, _to):
-	""" calculates times to cut FROM (in seconds) and TO (which is actually duration from start) """
+	""" calculates times to cut FROM and TO (which is actually duration from start), as pts on HandBrakes 90 kHz clock (--start-at pts:) """
 	_fromOut = timeToSeconds(_from)
 	_toOut = timeToSeconds(_to) - _fromOut	# because to must be DURATION
-	return (_fromOut, _toOut)
+	return (round(_fromOut * 90000), round(_toOut * 90000))
 
 
 def runProcess(cmd):
@@ -117,6 +475,1272 @@ def runProcess(cmd):
 			lineOut += out
 
 
+def tsText(raw):
+	""" Decodes a DVB text field (EN 300 468 annex A), dropping its leading character table selector """
+	if raw[:1] == b'\x15':
+		return raw[1:].decode('utf-8', 'replace').strip()
+	if raw[:1] == b'\x10':
+		raw = raw[3:]
+	elif raw[:1] and raw[0] < 0x20:
+		raw = raw[1:]
+	return raw.decode('latin-1').strip()
+
+
+def tsPackets(data):
+	""" Returns a memory-mapped transport stream as an (N, 188) uint8 view from its first sync byte, or None if it is not one """
+	head = np.frombuffer(data, dtype=np.uint8)
+	offset = next((n for n in range(188) if n + 376 < len(head) and head[n] == head[n + 188] == head[n + 376] == 0x47), None)
+	if offset is None:
+		return None
+	count = (len(head) - offset) // 188
+	return head[offset:offset + count * 188].reshape(count, 188)
+
+
+def tsSection(packets, pid, tableId):
+	""" Returns the first complete section with the table id carried on the PID, reassembled from the (N, 188) packets, or None """
+	def nextSection(buf):	# returns (section, rest) of the buffered sections, section None if it has not all arrived yet
+		while len(buf) >= 3 and buf[0] != 0xff:
+			length = ((buf[1] & 0x0f) << 8 | buf[2]) + 3
+			if len(buf) < length:
+				break
+			if buf[0] == tableId:
+				return buf[:length], b''
+			buf = buf[length:]			# another table shares the PID
+		return None, buf
+	buf = None
+	for packet in packets[(packets[:, 1].astype(np.int32) & 0x1f) << 8 | packets[:, 2] == pid]:
+		control = packet[3] >> 4
+		if not control & 1:
+			continue				# adaptation field only
+		payload = packet[4 + (1 + int(packet[4]) if control & 2 else 0):].tobytes()
+		if packet[1] & 0x40:				# a section starts here, after the pointer field ends the previous one
+			if buf:
+				section, rest = nextSection(buf + payload[1:1 + payload[0]])
+				if section:
+					return section
+			buf = payload[1 + payload[0]:]
+		elif buf is None:
+			continue
+		else:
+			buf += payload
+		section, buf = nextSection(buf)
+		if section:
+			return section
+	return None
+
+
+def tsDescriptors(data):
+	""" Yields (tag, body) of the descriptors in a descriptor loop """
+	pos = 0
+	while pos + 2 <= len(data):
+		yield data[pos], data[pos + 2:pos + 2 + data[pos + 1]]
+		pos += 2 + data[pos + 1]
+
+
+def probeTS(fileName):
+	""" Reads the PAT, PMT and SDT from the first tsProbeBytes of a transport stream, memory-mapped.
+	    Returns {'service' : name, 'streams' : [(pid, streamType, language, teletext)], 'subLang' : language}, or None if they are not found """
+	with open(fileName, 'rb') as tsFile:
+		size = os.fstat(tsFile.fileno()).st_size
+		if size < 188 * 3:
+			return None
+		packets = None
+		with mmap.mmap(tsFile.fileno(), min(size, tsProbeBytes), access=mmap.ACCESS_READ) as data:
+			view = tsPackets(data)
+			if view is not None:
+				packets = view[view[:, 0] == 0x47]		# a copy without the packets out of sync, so the map can be closed
+			del view
+	pat = tsSection(packets, 0x00, 0x00) if packets is not None else None
+	if not pat:
+		return None
+	programs = [(pat[n] << 8 | pat[n + 1], (pat[n + 2] & 0x1f) << 8 | pat[n + 3]) for n in range(8, len(pat) - 4, 4)]
+	program, pmtPid = next(((number, pid) for number, pid in programs if number), (None, None))	# program 0 points to the NIT
+	pmt = tsSection(packets, pmtPid, 0x02) if pmtPid else None
+	streams = []
+	if pmt:
+		pos = 12 + ((pmt[10] & 0x0f) << 8 | pmt[11])
+		while pos + 5 <= len(pmt) - 4:
+			streamType, pid, infoLength = pmt[pos], (pmt[pos + 1] & 0x1f) << 8 | pmt[pos + 2], (pmt[pos + 3] & 0x0f) << 8 | pmt[pos + 4]
+			language, teletext = None, False
+			for tag, body in tsDescriptors(pmt[pos + 5:pos + 5 + infoLength]):
+				if tag == 0x56:			# teletext: language, type and page of each entry, subtitle pages are type 2 or 5
+					entries = [body[n:n + 5] for n in range(0, len(body) - 4, 5)]
+					subtitles = [e for e in entries if e[3] >> 3 in (2, 5)] or entries
+					language, teletext = (subtitles[0][:3].decode('latin-1') if subtitles else language), True
+				elif tag in (0x0a, 0x59) and len(body) >= 3:	# ISO 639 language, DVB subtitling
+					language = body[:3].decode('latin-1')
+			streams.append((pid, streamType, language, teletext))
+			pos += 5 + infoLength
+	service = None
+	sdt = tsSection(packets, 0x11, 0x42)
+	if sdt:
+		pos = 11
+		while pos + 5 <= len(sdt) - 4:
+			serviceId, loopLength = sdt[pos] << 8 | sdt[pos + 1], (sdt[pos + 3] & 0x0f) << 8 | sdt[pos + 4]
+			for tag, body in tsDescriptors(sdt[pos + 5:pos + 5 + loopLength]):
+				if tag == 0x48 and (service is None or serviceId == program):	# service: type, provider, name
+					name = body[2 + body[1]:]
+					service = tsText(name[1:1 + name[0]]) if name else service
+			pos += 5 + loopLength
+	subLang = next((language for pid, streamType, language, teletext in streams if teletext and language), None)
+	return {'service' : service, 'streams' : streams, 'subLang' : languageCodes.get(subLang, subLang)}
+
+
+def reportStreams(fileName):
+	""" Prints the service and elementary streams found by probeTS """
+	started = time.time()
+	probe = probeTS(fileName)
+	if not probe:
+		print('\n  "%s" : no transport stream tables found in the first %d MB' % (fileName, tsProbeBytes // 2**20))
+		return
+	print('\n  "%s" : service %s, probed in %.1f ms' % (fileName, probe['service'], (time.time() - started) * 1000))
+	for pid, streamType, language, teletext in probe['streams']:
+		print('    PID %5d  type 0x%02x  %-4s %s' % (pid, streamType, language or '', 'teletext' if teletext else ''))
+
+
+def tsBlockErrors(block, lastCC):
+	""" Checks one (N, 188) block of packets, lastCC holding the continuity counter each PID ended the previous block with.
+	    Returns (indices of packets with sync, transport or continuity errors, counts of each, indices, PIDs and 33-bit bases of the PCRs) """
+	sync = block[:, 0] != 0x47
+	tei = ~sync & (block[:, 1] & 0x80 != 0)
+	pids = (block[:, 1].astype(np.int32) & 0x1f) << 8 | block[:, 2]
+	control = block[:, 3] >> 4
+	adaptation = ~sync & ~tei & (control & 2 != 0) & (block[:, 4] > 0)
+	# continuity: the counter of every PID steps by one per packet with payload (repeated once at most), unless the discontinuity flag is set.
+	# A packet with a transport error takes its slot with a counter that can not be trusted, so the packet after it is not checked either
+	checked = np.flatnonzero(~sync & (control & 1 != 0) & (pids != 0x1fff))
+	order = checked[np.argsort(pids[checked], kind='stable')]
+	pid, cc, discontinuity = pids[order], (block[order, 3] & 0x0f).astype(np.int16), adaptation[order] & (block[order, 5] & 0x80 != 0)
+	cc[tei[order]] = -1
+	first, last = np.ones(len(order), dtype=bool), np.ones(len(order), dtype=bool)
+	first[1:] = last[:-1] = pid[1:] != pid[:-1]
+	previous = np.empty_like(cc)
+	previous[1:] = cc[:-1]
+	previous[first] = lastCC[pid[first]]
+	lost = order[((cc - previous) % 16 > 1) & (previous >= 0) & (cc >= 0) & ~discontinuity]
+	lastCC[pid[last]] = cc[last]
+	pcr = np.flatnonzero(adaptation & (block[:, 5] & 0x10 != 0))
+	fields = block[pcr, 6:11].astype(np.int64)
+	bases = fields[:, 0] << 25 | fields[:, 1] << 17 | fields[:, 2] << 9 | fields[:, 3] << 1 | fields[:, 4] >> 7
+	errors = np.concatenate([np.flatnonzero(sync | tei), lost])
+	return errors, (int(sync.sum()), int(tei.sum()), len(lost)), pcr, pids[pcr], bases
+
+
+def scanTS(fileName):
+	""" Checks sync bytes, transport error indicators, continuity counters and PCR gaps of a whole transport stream, memory-mapped and viewed
+	    as (N, 188) blocks. Returns {'packets', 'seconds', 'sync', 'tei', 'continuity', 'pcrGaps', 'perMinute', 'elapsed'}, or None if it is not one """
+	started = time.time()
+	lastCC = np.full(8192, -1, dtype=np.int16)
+	errors, pcrs, counts = [], [], np.zeros(3, dtype=np.int64)
+	with open(fileName, 'rb') as tsFile:
+		if os.fstat(tsFile.fileno()).st_size < 188 * 3:
+			return None
+		with mmap.mmap(tsFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			packets = tsPackets(data)
+			if packets is None:
+				return None
+			count = len(packets)
+			for start in range(0, count, tsScanPackets):
+				blockErrors, blockCounts, pcr, pcrPids, bases = tsBlockErrors(packets[start:start + tsScanPackets], lastCC)
+				errors.append(start + blockErrors)
+				pcrs.append((start + pcr, pcrPids, bases))
+				counts += blockCounts
+			del packets
+	errors = np.concatenate(errors)
+	pcr, pcrPids, bases = (np.concatenate(column) for column in zip(*pcrs))
+	gaps, seconds, times = 0, 0.0, np.zeros(len(errors))
+	if len(pcr):
+		pcrPid = np.bincount(pcrPids).argmax()		# the programme clock, when several PIDs carry one
+		pcr, bases = pcr[pcrPids == pcrPid], bases[pcrPids == pcrPid]
+		steps = np.diff(bases) % 2**33 / 90000.0	# the 33-bit base wraps after 26.5 hours
+		gapped = steps > pcrMaxGap
+		gaps = int(gapped.sum())
+		errors = np.concatenate([errors, pcr[1:][gapped]])
+		clock = np.concatenate([[0], np.cumsum(np.where(steps < 10, steps, 0))])	# longer jumps are clock discontinuities, not time passing
+		times, seconds = np.interp(errors, pcr, clock), float(clock[-1])
+	return {'packets' : count, 'seconds' : seconds, 'sync' : int(counts[0]), 'tei' : int(counts[1]), 'continuity' : int(counts[2]), 'pcrGaps' : gaps,
+		'perMinute' : np.bincount((times // 60).astype(int), minlength=int(seconds // 60) + 1), 'elapsed' : time.time() - started}
+
+
+def reportTS(fileName, scan):
+	""" Prints the errors found by scanTS per minute, returns True if the recording is fit to be processed """
+	if not scan:
+		print('\n  "%s" : not a transport stream, not checked' % fileName)
+		return True
+	size = scan['packets'] * 188 / 2**20
+	print('\n  Checked %d MB (%s) of "%s" in %.1f seconds (%.0f MB/sec)' % (size, secondsToTime(scan['seconds']), fileName, scan['elapsed'], size / max(scan['elapsed'], 0.001)))
+	print('    Sync errors %d, transport errors %d, continuity errors %d, PCR gaps %d' % (scan['sync'], scan['tei'], scan['continuity'], scan['pcrGaps']))
+	for minute in np.flatnonzero(scan['perMinute']):
+		print('    %s : %d error(s)' % (secondsToTime(minute * 60), scan['perMinute'][minute]))
+	if scan['perMinute'].max() > tsMaxErrors:
+		print('    More than %d errors in a minute, the recording is broken' % tsMaxErrors)
+		return False
+	return True
+
+
+def probeVideo(fileName):
+	""" Returns (fps, frameCount, width, height) of the first video stream, as reported by ffprobe """
+	cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height,avg_frame_rate:format=duration', '-of', 'json', fileName]
+	info = json.loads(subprocess.run(cmd, stdout=subprocess.PIPE, text=True).stdout)
+	stream = info['streams'][0]
+	num, den = stream['avg_frame_rate'].split('/')
+	fps = float(num) / float(den)
+	return fps, float(info['format']['duration']) * fps, int(stream['width']), int(stream['height'])
+
+
+def openSource(fileName, decoder, sequential=True, gray=False):
+	""" Opens the recording with the named decoder backend """
+	source = openCVSource(fileName, sequential) if decoder == 'opencv' else frameSources[decoder](fileName)
+	source.gray = gray
+	return source
+
+
+def readFrames(stream, shape):
+	""" Yields raw frames read with readinto() from the stream, as views of a preallocated ring buffer """
+	ring = np.empty((ringSlots,) + shape, dtype=np.uint8)
+	slot = 0
+	while True:
+		view = memoryview(ring[slot]).cast('B')
+		filled = 0
+		while filled < len(view):
+			count = stream.readinto(view[filled:])
+			if not count:
+				return
+			filled += count
+		yield ring[slot]
+		slot = (slot + 1) % ringSlots
+
+
+def benchmarkDecoder(job):
+	""" Pool worker: decodes the start of the recording with one backend, returns (frames, seconds, cpu seconds, peak RSS in kB) """
+	fileName, decoder = job
+	source = openSource(fileName, decoder, gray=True)	# as the matcher reads it
+	frames = 0
+	started = time.time()
+	for frameNo, img in source.frames(0, int(benchmarkSeconds * source.fps), 1):
+		frames += 1
+	elapsed = time.time() - started
+	source.release()
+	own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)	# children holds the ffmpeg subprocess
+	cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+	return frames, elapsed, cpu, max(own.ru_maxrss, children.ru_maxrss)
+
+
+def benchmarkDecoders(fileName):
+	""" Decodes the start of the recording with every backend (each in a fresh process) and prints a comparison """
+	print('\n  Benchmarking decoders on the first %d seconds of "%s":\n' % (benchmarkSeconds, os.path.basename(fileName)))
+	print('    %-8s %10s %12s %10s %14s' % ('Decoder', 'Frames', 'Frames/sec', 'CPU sec', 'Peak RSS (MB)'))
+	for decoder in frameSources:
+		if decoder == 'pyav':
+			try:
+				import av
+			except ImportError:
+				print('    %-8s not installed, skipped' % decoder)
+				continue
+		with multiprocessing.get_context('fork').Pool(1) as pool:
+			frames, elapsed, cpu, rss = pool.apply(benchmarkDecoder, ((fileName, decoder),))
+		print('    %-8s %10d %12.1f %10.1f %14.1f' % (decoder, frames, frames / max(elapsed, 0.001), cpu, rss / 1024.0))
+
+
+def seekFrames(cap, start, stop, step):
+	""" Yields (frameNumber, image) for every step'th frame, seeking to each of them (the image buffer is reused) """
+	img = None
+	frameNo = start
+	while frameNo < stop:
+		cap.set(cv2.CAP_PROP_POS_FRAMES, frameNo)
+		ret, img = cap.read(img)
+		if not ret:
+			return
+		yield frameNo, img
+		frameNo += step
+
+
+def grabFrames(cap, start, stop, step):
+	""" Yields (frameNumber, image) for every step'th frame, walking the file forward once (grab() skips, retrieve() decodes into a reused buffer) """
+	img = None
+	if start:
+		cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+	frameNo = start
+	while frameNo < stop:
+		if not cap.grab():
+			return
+		if (frameNo - start) % step == 0:
+			ret, img = cap.retrieve(img)
+			if not ret:
+				return
+			yield frameNo, img
+		frameNo += 1
+
+
+def cropBox(img, box):
+	""" Returns the part of the frame inside box (left, top, right, bottom as fractions of the frame) as a view, or the frame if box is None """
+	if box is None:
+		return img
+	height, width = img.shape[:2]
+	return img[round(box[1] * height):round(box[3] * height), round(box[0] * width):round(box[2] * width)]
+
+
+def makeSignature(img, size, box=None):
+	""" Returns the low-resolution, area-averaged luma signature of a BGR (or gray) frame, or of the region of it inside box """
+	small = cv2.resize(cropBox(img, box), size, interpolation=cv2.INTER_AREA)	# crop and downscale first, so colour conversion only touches the small image
+	return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+
+def signatureDifference(ref, sig, weight=None, limit=None):
+	""" Returns the mean absolute luma difference (0-255) between two signatures, weighted by the reference mask if any """
+	return referenceDifferences(ref[np.newaxis], sig[np.newaxis], None if weight is None else weight[np.newaxis], limit)[0, 0]
+
+
+def referenceDifferences(refs, sigs, weights=None, limit=None):
+	""" Returns the mean absolute difference of every frame signature to every stacked reference, as (frames, references).
+	    With a limit, rows are summed abandonRows at a time and pairs whose partial sum already exceeds it are dropped as inf """
+	refs = refs.reshape(len(refs), refs.shape[1], -1).astype(np.float32)
+	sigs = sigs.reshape(len(sigs), sigs.shape[1], -1).astype(np.float32)
+	weights = np.ones(refs.shape, dtype=np.float32) if weights is None else weights.reshape(refs.shape).astype(np.float32)
+	total = weights.sum(axis=(1, 2))
+	sums = np.zeros((len(sigs), len(refs)), dtype=np.float32)
+	if limit is None:
+		sums += np.einsum('frhw,rhw->fr', np.abs(refs[np.newaxis] - sigs[:, np.newaxis]), weights)
+		return sums / total
+	budget = limit * total
+	frames, cands = np.nonzero(sums <= budget)		# (frame, reference) pairs still alive
+	for row in range(0, refs.shape[1], abandonRows):
+		rows = slice(row, row + abandonRows)
+		sums[frames, cands] += (np.abs(refs[cands, rows] - sigs[frames, rows]) * weights[cands, rows]).sum(axis=(1, 2))
+		alive = sums[frames, cands] <= budget[cands]
+		frames, cands = frames[alive], cands[alive]
+		if not len(frames):
+			break
+	differences = np.full(sums.shape, np.inf, dtype=np.float32)
+	differences[frames, cands] = sums[frames, cands] / total[cands]
+	return differences
+
+
+def bestReference(refs, sig, weights=None, limit=None):
+	""" Compares a frame signature to all references at once, returns (difference, index) of the closest one (inf when none is within limit) """
+	differences = referenceDifferences(refs, sig[np.newaxis], weights, limit)[0]
+	best = int(differences.argmin())
+	return differences[best], best
+
+
+def refineMatch(source, refs, kind, ref, sigSize, frameNo, radius):
+	""" Compares every frame within radius of a coarse match to the reference, returns (frameNumber, difference) of the best one """
+	ids, sigs, hashes, weights = refs[kind]
+	weight = None if weights is None else weights[ref]
+	best = (frameNo, None)
+	for candidate, img in source.frames(max(frameNo - radius, 0), frameNo + radius + 1, 1):
+		difference = signatureDifference(sigs[ref], makeSignature(img, sigSize, refs['box']), weight, best[1])	# frames worse than the best so far are abandoned early
+		if best[1] is None or difference < best[1]:
+			best = (candidate, difference)
+	return best
+
+
+def scanSegment(job):
+	""" Pool worker: scans one range of frames with its own capture, returns (frameNumber, difference, reference) of the frames matching """
+	fileName, decoder, start, stop, step, refs, sigSize = job
+	started = time.time()
+	source = openSource(fileName, decoder, gray=True)
+	hitsFROM, hitsTO = [], []
+	batch = np.empty((matchBatch, sigSize[1], sigSize[0]), dtype=np.uint8)
+	frameNumbers = []
+	def compareBatch():	# all batched frames against all references of each kind in one broadcast
+		for kind, limit, hits in (('FROM', diffMinFROM, hitsFROM), ('TO', diffMinTO, hitsTO)):
+			differences = referenceDifferences(refs[kind][1], batch[:len(frameNumbers)], refs[kind][3], limit)
+			best = differences.argmin(axis=1)
+			for n in np.flatnonzero(differences[np.arange(len(best)), best] < limit):
+				hits.append((frameNumbers[n], differences[n, best[n]], int(best[n])))
+		del frameNumbers[:]
+	for frameNo, img in source.frames(start, stop, step):
+		batch[len(frameNumbers)] = makeSignature(img, sigSize, refs['box'])
+		frameNumbers.append(frameNo)
+		if len(frameNumbers) == matchBatch:
+			compareBatch()
+	if frameNumbers:
+		compareBatch()
+	source.release()
+	return hitsFROM, hitsTO, time.time() - started
+
+
+def parallelScan(fileName, decoder, windowFROM, windowTO, searchEnd, step, refs, sigSize, workers):
+	""" Splits the search windows in ranges scanned by a pool of workers, returns the earliest FROM and the first TO after it """
+	ranges = sorted([windowFROM] + ([windowTO] if windowTO else []))
+	if len(ranges) == 2 and ranges[1][0] <= ranges[0][1]:
+		ranges = [(ranges[0][0], max(ranges[0][1], ranges[1][1]))]	# overlapping windows are scanned once
+	jobs = []
+	for start, stop in ranges:
+		samples = int((stop - start) // step)
+		bounds = [start + int(samples * n / workers) * step for n in range(workers)] + [int(stop)]	# ranges start on the sampling grid
+		jobs += [(fileName, decoder, bounds[n], bounds[n + 1], step, refs, sigSize) for n in range(workers) if bounds[n] < bounds[n + 1]]
+	started = time.time()
+	with multiprocessing.get_context('fork').Pool(workers) as pool:
+		results = pool.map(scanSegment, jobs)
+	elapsed = max(time.time() - started, 0.001)
+	print("\n  Scanned %d frames with %d workers in %.1f seconds (speedup %.1fx)" % (sum(stop - start for start, stop in ranges), workers, elapsed, sum(r[2] for r in results) / elapsed))
+	hitsFROM = sorted(hit for r in results for hit in r[0] if windowFROM[0] <= hit[0] < windowFROM[1])
+	hitsTO = sorted(hit for r in results for hit in r[1])
+	if not hitsFROM:
+		return None, None
+	matchFROM = hitsFROM[0]
+	start, stop = windowAfter(windowTO, matchFROM[0], searchEnd)
+	matchTO = next((hit for hit in hitsTO if start <= hit[0] < stop), None)
+	return matchFROM, matchTO
+
+
+def keyframeSignatures(fileName, sigSize, box=None, start=0, stop=None):
+	""" Yields (seconds, signature) for every keyframe from start to stop (seconds), decoded by ffmpeg (-skip_frame nokey) and piped as raw gray video """
+	width, height = sigSize
+	crop = 'crop=iw*%f:ih*%f:iw*%f:ih*%f,' % (box[2] - box[0], box[3] - box[1], box[0], box[1]) if box else ''
+	seek = ['-ss', '%.3f' % start] if start else []
+	duration = ['-t', '%.3f' % (stop - start)] if stop else []
+	cmd = ['ffmpeg', '-nostdin', '-nostats', '-skip_frame', 'nokey'] + seek + ['-i', fileName] + duration + ['-an', '-sn', '-vsync', 'passthrough',
+		'-vf', crop + 'scale=%d:%d:flags=area,format=gray,showinfo' % sigSize, '-f', 'rawvideo', '-']
+	process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	timestamps = queue.Queue()
+	def readTimestamps():	# showinfo logs each frame on stderr before it is written to stdout
+		for line in process.stderr:
+			if b'pts_time:' in line:
+				timestamps.put(float(line.split(b'pts_time:')[1].split()[0]))
+	threading.Thread(target=readTimestamps, daemon=True).start()
+	try:
+		for sig in readFrames(process.stdout, (height, width)):
+			yield start + timestamps.get(timeout=10), sig	# timestamps restart at 0 after -ss
+	finally:
+		process.kill()
+		process.wait()
+
+
+def firstKeyframeMatch(fileName, refs, kind, sigSize, start, stop, limit):
+	""" Returns ((seconds, reference), keyframes checked) for the first keyframe from start to stop (seconds) matching a reference of the kind """
+	keyframes = 0
+	for seconds, sig in keyframeSignatures(fileName, sigSize, refs['box'], start, stop):
+		keyframes += 1
+		difference, ref = bestReference(refs[kind][1], sig, refs[kind][3], limit)
+		if difference < limit:
+			return (seconds, ref), keyframes
+	return None, keyframes
+
+
+def keyframeScan(fileName, refs, sigSize, fps, windowFROM, windowTO, searchEnd):
+	""" Finds the first keyframe matching FROM and the first one matching TO after it, returns (seconds, reference) of each """
+	started = time.time()
+	matchFROM, keyframes = firstKeyframeMatch(fileName, refs, 'FROM', sigSize, windowFROM[0] / fps, windowFROM[1] / fps, diffMinFROM)
+	matchTO = None
+	if matchFROM:
+		start, stop = windowAfter(windowTO, int(matchFROM[0] * fps), searchEnd)
+		matchTO, keyframesTO = firstKeyframeMatch(fileName, refs, 'TO', sigSize, start / fps, stop / fps, diffMinTO)
+		keyframes += keyframesTO
+	elapsed = max(time.time() - started, 0.001)
+	print("\n  Checked %d keyframes in %.1f seconds (%.1f keyframes/sec, keyframe mode)" % (keyframes, elapsed, keyframes / elapsed))
+	return matchFROM, matchTO
+
+
+def dHash(img):
+	""" Returns the 64-bit difference hash of a BGR (or gray) frame """
+	small = makeSignature(img, (9, 8))
+	bits = small[:, 1:] > small[:, :-1]
+	return np.packbits(bits).view('>u8').astype(np.uint64)[0]
+
+
+def hammingDistances(hashes, refHash):
+	""" Returns the number of differing bits between each hash in the array and the reference hash """
+	xor = np.bitwise_xor(hashes, np.uint64(refHash))
+	return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def loadHashIndex(fh):
+	""" Returns the per-second hash index of the recording, or None if it is missing or outdated """
+	if not os.path.exists(fh.sidecar('.dhash.json')) or not os.path.exists(fh.sidecar('.dhash.npy')):
+		return None
+	with open(fh.sidecar('.dhash.json')) as metaFile:
+		meta = json.load(metaFile)
+	if meta.get('stamp') != fh.stamp():
+		return None
+	return np.load(fh.sidecar('.dhash.npy'))
+
+
+def buildHashIndex(fh, source, fps, frameCount):
+	""" Decodes the recording once and stores a dHash per second of video as a .npy sidecar """
+	hashes = []
+	scanStarted = time.time()
+	for frameNo, img in source.frames(0, frameCount, fps):
+		hashes.append(dHash(img))
+		if len(hashes) % 60 == 0:
+			print('    Indexed ' + secondsToTime(len(hashes)) + '\r', end='', flush=True)
+	reportScanSpeed('index', len(hashes) * fps, scanStarted)
+	hashes = np.array(hashes, dtype=np.uint64)
+	saveHashIndex(fh, hashes, fps)
+	return hashes
+
+
+def loadSceneIndex(fh):
+	""" Returns (shot boundaries in ms, frames scanned) of the scene index, or None if there is none or the recording
+	    was replaced or changed other than by growing """
+	if not os.path.exists(fh.sidecar('.scenes.json')) or not os.path.exists(fh.sidecar('.scenes.npy')):
+		return None
+	with open(fh.sidecar('.scenes.json')) as metaFile:
+		meta = json.load(metaFile)
+	info = os.stat(fh.fullPath)
+	if meta['inode'] != info.st_ino or info.st_size < meta['size']:
+		return None
+	return np.load(fh.sidecar('.scenes.npy')), meta['scanned']
+
+
+def saveSceneIndex(fh, cuts, scanned):
+	""" Stores the shot boundaries as an int32 millisecond array sidecar of the recording """
+	np.save(fh.sidecar('.scenes.npy'), np.array(cuts, dtype=np.int32))
+	info = os.stat(fh.fullPath)
+	with open(fh.sidecar('.scenes.json'), 'w') as metaFile:	# written last, so a partial index never validates
+		json.dump({'inode' : info.st_ino, 'size' : info.st_size, 'scanned' : scanned}, metaFile)
+
+
+def nearestScene(fh, seconds, radius):
+	""" Returns the shot boundary nearest to seconds, if the scene index has one within radius, else seconds """
+	index = loadSceneIndex(fh)
+	if index is None or not len(index[0]):
+		return seconds
+	cuts = index[0] / 1000.0
+	nearest = float(cuts[np.abs(cuts - seconds).argmin()])
+	return nearest if abs(nearest - seconds) <= radius else seconds
+
+
+def saveHashIndex(fh, hashes, fps):
+	""" Stores the per-second hashes as a .npy sidecar of the recording """
+	np.save(fh.sidecar('.dhash.npy'), hashes)
+	with open(fh.sidecar('.dhash.json'), 'w') as metaFile:	# written last, so a partial index never validates
+		json.dump({'stamp' : fh.stamp(), 'fps' : fps}, metaFile)
+
+
+def pipeBlocks(cmd, blockBytes):
+	""" Yields the raw output of an ffmpeg command in blocks of blockBytes (the last one may be shorter) """
+	process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+	try:
+		while True:
+			block = process.stdout.read(blockBytes)
+			if not block:
+				return
+			yield block
+	finally:
+		process.kill()
+		process.wait()
+
+
+def audioLevels(fileName):
+	""" Returns the RMS level (dBFS) of each gapWindow of the first audio stream, decoded to mono gapRate PCM """
+	samples = int(gapWindow * gapRate)
+	cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-i', fileName, '-map', '0:a:0?', '-ac', '1', '-ar', str(gapRate), '-f', 's16le', '-']
+	levels = []
+	for block in pipeBlocks(cmd, samples * 2 * 300):	# 300 windows per read
+		pcm = np.frombuffer(block, dtype=np.int16)
+		pcm = pcm[:len(pcm) // samples * samples].reshape(-1, samples).astype(np.float32)
+		levels.append(20 * np.log10(np.sqrt((pcm ** 2).mean(axis=1)) / 32768 + 1e-10))
+	return np.concatenate(levels) if levels else np.empty(0, dtype=np.float32)
+
+
+def lumaLevels(fileName):
+	""" Returns the mean luma of each gapWindow of the first video stream, from frames ffmpeg scales down to 16x9 """
+	cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-i', fileName, '-map', '0:v:0', '-vf', 'fps=%g,scale=16:9:flags=area,format=gray' % (1 / gapWindow), '-f', 'rawvideo', '-']
+	levels = [np.frombuffer(block, dtype=np.uint8)[:len(block) // 144 * 144].reshape(-1, 144).mean(axis=1) for block in pipeBlocks(cmd, 144 * 300)]
+	return np.concatenate(levels) if levels else np.empty(0, dtype=np.float32)
+
+
+def blackSilentGaps(fileName):
+	""" Returns (start, stop) in seconds of every gap of at least gapMin where the picture is black and the sound silent """
+	luma = lumaLevels(fileName)
+	audio = audioLevels(fileName)
+	if len(audio) == 0:
+		print('    No audio found, detecting black frames only')
+		audio = np.full(len(luma), silenceLevel - 1.0)
+	count = min(len(luma), len(audio))
+	gap = np.concatenate(([False], (luma[:count] < blackLevel) & (audio[:count] < silenceLevel), [False]))
+	edges = np.flatnonzero(np.diff(gap.astype(np.int8)))	# alternating starts and stops of the gaps
+	starts, stops = edges[0::2], edges[1::2]
+	keep = (stops - starts) * gapWindow >= gapMin - 1e-6
+	return [(start * gapWindow, stop * gapWindow) for start, stop in zip(starts[keep], stops[keep])]
+
+
+def reportGaps(fh, gaps):
+	""" Prints the black and silent gaps found, and the cutout they suggest when the DVR log has a schedule for the recording """
+	print('\n  %d black and silent gap(s) found:\n' % len(gaps))
+	for start, stop in gaps:
+		print('    %s - %s (%.1f s)' % (secondsToTime(float(start)), secondsToTime(float(stop)), stop - start))
+	schedule = dvrSchedule(fh) if not args.ignoreDvrLog else None
+	if gaps and schedule:
+		fra = min(gaps, key=lambda gap: abs(gap[1] - schedule[0]))	# programme starts when the gap ends
+		til = min(gaps, key=lambda gap: abs(gap[0] - schedule[1]))	# and ends when the next gap starts
+		if fra[1] < til[0]:
+			print("\n  Gaps nearest to the DVR schedule suggest:")
+			print("     sudo ./recordingsTools.py '%s' --mux --cutout '%s,%s'\n" % (fh.fullPath, secondsToTime(float(fra[1])), secondsToTime(float(til[0]))))
+
+
+def audioConstellation(fileName):
+	""" Returns the STFT peak constellation of the first audio stream: a (frames, bins) bool map of the spectral peaks,
+	    jingleHop samples of mono jingleRate audio per frame. Audio is decoded by ffmpeg and transformed in blocks """
+	cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-i', fileName, '-map', '0:a:0?', '-ac', '1', '-ar', str(jingleRate), '-f', 's16le', '-']
+	window = np.hanning(jingleFFT).astype(np.float32)
+	maps = []
+	tail = np.empty(0, dtype=np.float32)
+	for block in pipeBlocks(cmd, jingleHop * 2 * 4096):
+		pcm = np.concatenate((tail, np.frombuffer(block, dtype=np.int16).astype(np.float32) / 32768))
+		if len(pcm) < jingleFFT:
+			tail = pcm
+			continue
+		frames = np.lib.stride_tricks.sliding_window_view(pcm, jingleFFT)[::jingleHop]
+		spectrum = np.log(np.abs(np.fft.rfft(frames * window, axis=1)) + 1e-3).astype(np.float32)
+		peaks = np.where(spectrum == cv2.dilate(spectrum, np.ones((3, 9), np.uint8)), spectrum, -np.inf)	# maxima of their time/frequency neighbourhood
+		strongest = np.partition(peaks, -jinglePeaks, axis=1)[:, -jinglePeaks:-jinglePeaks + 1]
+		maps.append((peaks >= strongest) & (peaks > np.median(spectrum, axis=1, keepdims=True) + 2))	# the strongest of each frame, well above its noise floor
+		tail = pcm[len(frames) * jingleHop:]		# samples of frames not complete in this block
+	return np.concatenate(maps) if maps else np.zeros((0, jingleFFT // 2 + 1), dtype=bool)
+
+
+def jingleScores(recording, jingle, tolerance=1):
+	""" Returns the fraction of the jingle's peaks found in the recording (within tolerance frames) for every offset of it """
+	count = len(recording) - len(jingle) + 1
+	if count < 1 or not jingle.any():
+		return np.zeros(0, dtype=np.float32)
+	tolerant = np.ascontiguousarray(cv2.dilate(recording.view(np.uint8), np.ones((2 * tolerance + 1, 1), np.uint8)).T)	# (bins, frames)
+	scores = np.zeros(count, dtype=np.float32)
+	times, bins = np.nonzero(jingle)
+	for t, f in zip(times, bins):		# cross-correlation of the binary maps, one shifted row per peak
+		scores += tolerant[f, t:t + count]
+	return scores / len(times)
+
+
+def jingleFiles(service):
+	""" Returns {'FROM' : [clips], 'TO' : [clips]} of the service's audio jingles (refJingleFROM/TO.wav in the current directory, if unknown) """
+	if not service:
+		return {kind : ["refJingle%s.wav" % kind] if os.path.exists("refJingle%s.wav" % kind) else [] for kind in ('FROM', 'TO')}
+	folder = os.path.join(refLibrary, service.upper())
+	clips = sorted(f for f in os.listdir(folder) if f.endswith('.wav')) if os.path.isdir(folder) else []
+	return {kind : [os.path.join(folder, f) for f in clips if f.split('_')[0] == kind] for kind in ('FROM', 'TO')}
+
+
+def saveJingle(service, kind, fileName, start, stop):
+	""" Cuts the audio from start to stop (seconds) of the recording into a new jingle clip of the service """
+	clip = referencePath(service, kind, '.wav', 'refJingle%s')
+	subprocess.run(['ffmpeg', '-nostdin', '-v', 'error', '-y', '-ss', '%.3f' % start, '-t', '%.3f' % (stop - start), '-i', fileName, '-vn', '-sn', '-ac', '1', '-ar', str(jingleRate), clip], check=True)
+	os.chmod(clip, 0o777)
+	print('    Saved jingle "%s"' % clip)
+
+
+def jingleScan(fh, clips):
+	""" Searches the audio of the recording for the FROM and TO jingles, returns {'FROM' : (timestamp, difference, reference), 'TO' : (...)} or None.
+	    The programme starts where a FROM jingle starts and ends where a TO jingle ends """
+	started = time.time()
+	rate = float(jingleRate) / jingleHop		# constellation frames per second
+	recording = audioConstellation(fh.fullPath)
+	print("\n  Fingerprinted %s of audio in %.1f seconds" % (secondsToTime(int(len(recording) / rate)), time.time() - started))
+	source = openSource(fh.fullPath, 'opencv')	# only for the frame rate skipAfterFROM is counted in
+	fps = source.fps
+	source.release()
+	searchEnd = len(recording)
+	windowFROM, windowTO = searchWindows(fh, rate, searchEnd)
+	found = {}
+	for kind in ('FROM', 'TO'):
+		if kind == 'FROM':
+			start, stop = windowFROM
+		else:
+			start, stop = windowAfter(windowTO, int(found['FROM'][3] * rate), searchEnd, int(skipAfterFROM / fps * rate))
+		best = None
+		for clip in clips[kind]:
+			jingle = audioConstellation(clip)
+			scores = jingleScores(recording, jingle)[start:stop]
+			hits = np.flatnonzero(scores >= jingleMinScore)
+			print("    %-20s best score %.2f" % (os.path.basename(clip), scores.max() if len(scores) else 0.0))
+			if len(hits) and (best is None or start + int(hits[0]) < best[4]):	# the clip heard first wins, in absolute offsets
+				window = scores[hits[0]:hits[0] + int(rate)]		# strongest offset within a second of the first hit
+				plateau = start + int(hits[0]) + np.flatnonzero(window == window.max())
+				exact = jingleScores(recording[plateau[0]:plateau[-1] + len(jingle)], jingle, 0)[plateau - plateau[0]]	# the tolerance scores neighbouring offsets alike
+				offset = int(plateau[exact.argmax()])
+				best = (offset, 1 - scores[offset - start], os.path.basename(clip), len(jingle), start + int(hits[0]))
+		if best is None:
+			return None
+		seconds = best[0] / rate if kind == 'FROM' else ((best[0] + best[3] - 1) * jingleHop + jingleFFT) / float(jingleRate)	# end of the last STFT frame
+		found[kind] = (secondsToTime(seconds), best[1], best[2], best[0] / rate)
+		print("    Match was found at : ", found[kind][0], "(%s, score %.2f)" % (best[2], 1 - best[1]))
+	return {kind : found[kind][:3] for kind in found}
+
+
+def readSrt(fileName):
+	""" Returns (cues, texts) of an .srt file: (start, end) in seconds of every cue as an (n, 2) array, and the text lines of each """
+	cues, texts = [], []
+	with open(fileName, encoding='utf-8', errors='replace') as srtFile:
+		for block in srtFile.read().replace('\r', '').split('\n\n'):
+			lines = block.strip('\n').split('\n')
+			timing = next((n for n, line in enumerate(lines) if '-->' in line), None)
+			if timing is None:
+				continue
+			fra, til = lines[timing].split('-->')
+			cues.append((timeToSeconds(fra.strip().replace(',', '.')), timeToSeconds(til.split()[0].replace(',', '.'))))
+			texts.append(lines[timing + 1:])
+	return np.array(cues, dtype=np.float64).reshape(-1, 2), texts
+
+
+def srtCues(fileName):
+	""" Returns (start, end) in seconds of every cue in an .srt file, as an (n, 2) array """
+	return readSrt(fileName)[0]
+
+
+def srtTime(seconds):
+	""" Returns seconds as an .srt timestamp (hh:mm:ss,mmm) """
+	ms = int(round(seconds * 1000))
+	return '%02d:%02d:%02d,%03d' % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+
+def retimeSrt(fileName, ranges, outFile):
+	""" Writes the cues of an .srt file that fall in the kept (from, to) ranges to outFile, on the timeline of the ranges joined.
+	    Cues are clipped to their range, cues outside all ranges are dropped; returns the number of cues kept """
+	cues, texts = readSrt(fileName)
+	starts = np.array([timeToSeconds(fra) for fra, til in ranges])
+	ends = np.array([timeToSeconds(til) for fra, til in ranges])
+	offsets = np.concatenate(([0], np.cumsum(ends - starts)[:-1]))	# where each range starts once joined
+	inRange = []
+	for column in (0, 1):		# range holding the start, and the end, of every cue (or -1)
+		index = np.searchsorted(starts, cues[:, column], side='right') - 1
+		inRange.append(np.where((index >= 0) & (cues[:, column] < ends[np.maximum(index, 0)]), index, -1))
+	index = np.where(inRange[0] >= 0, inRange[0], inRange[1])		# a cue starting before a range counts from its start
+	keep = index >= 0
+	index = np.maximum(index, 0)
+	retimed = np.clip(cues, starts[index, None], ends[index, None]) - starts[index, None] + offsets[index, None]
+	keep &= retimed[:, 1] > retimed[:, 0]
+	with open(outFile, 'w', encoding='utf-8') as srtFile:
+		for number, n in enumerate(np.flatnonzero(keep)):
+			srtFile.write('%d\n%s --> %s\n%s\n\n' % (number + 1, srtTime(retimed[n, 0]), srtTime(retimed[n, 1]), '\n'.join(texts[n])))
+	return int(keep.sum())
+
+
+def subtitleSpan(fh):
+	""" Returns (start, stop, confidence) of the programme estimated from the teletext subtitles, extracted with ccextractor if needed.
+	    Cues are clustered at gaps of subtitleGap and the programme is the cluster with most subtitled time. Each end of it is certain
+	    when a cue-free gap separates it from other subtitles, else as certain as it agrees with the DVR schedule; confidence is the lesser """
+	srt = fh.sidecar('.srt')
+	if not os.path.exists(srt):
+		if not fh.service or fh.service.upper() not in serviceList:
+			print('    No teletext page known for service "%s", no subtitle hint' % fh.service)
+			return None
+		print('\n  Extracting subtitles from "' + fh.fileName + '":')
+		runProcess(extJobs[1] % (srt, serviceList[fh.service.upper()], fh.fullPath))
+	cues = srtCues(srt) if os.path.exists(srt) else np.empty((0, 2))
+	if len(cues) < subtitleMinCues:
+		print('    Only %d subtitle cue(s) found, no subtitle hint' % len(cues))
+		return None
+	cues = cues[np.argsort(cues[:, 0])]
+	breaks = np.flatnonzero(cues[1:, 0] - np.maximum.accumulate(cues[:-1, 1]) > subtitleGap) + 1
+	clusters = np.split(np.arange(len(cues)), breaks)
+	durations = np.array([(cues[c, 1] - cues[c, 0]).sum() for c in clusters])
+	index = int(durations.argmax())
+	main = clusters[index]
+	print('    %d subtitle cue(s) in %d cluster(s), the programme cluster has %d' % (len(cues), len(clusters), len(main)))
+	start, stop = max(cues[main[0], 0] - subtitlePad, 0), cues[main, 1].max() + subtitlePad
+	schedule = None if args.ignoreDvrLog else dvrSchedule(fh)
+	sides = []
+	for side, (boundary, separated) in enumerate(((start, index > 0), (stop, index < len(clusters) - 1))):
+		if separated:
+			sides.append(1.0)		# other subtitles end (or start) more than subtitleGap away
+		elif schedule:
+			sides.append(max(1 - abs(boundary - schedule[side]) / dvrMargin, 0.0))
+		else:
+			sides.append(0.0)		# the programme may open (or close) without subtitles
+	return nearestScene(fh, start, subtitlePad), nearestScene(fh, stop, subtitlePad), min(sides)	# snapped to shots, if indexed
+
+
+def cornerFrames(fileName, box, seconds):
+	""" Yields blocks of (frames, height, width) gray logo corners, one every <seconds> of the recording.
+	    ffmpeg crops each frame before scaling and converting it, so only the corner is processed """
+	width, height = logoSize
+	vf = 'fps=1/%g,crop=iw*%f:ih*%f:iw*%f:ih*%f,scale=%d:%d:flags=area,format=gray' % (seconds, box[2] - box[0], box[3] - box[1], box[0], box[1], width, height)
+	cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-i', fileName, '-map', '0:v:0', '-an', '-sn', '-vf', vf, '-f', 'rawvideo', '-']
+	for block in pipeBlocks(cmd, width * height * 600):
+		yield np.frombuffer(block, dtype=np.uint8)[:len(block) // (width * height) * width * height].reshape(-1, height, width)
+
+
+def logoFolder(service):
+	""" Returns the library folder the logo template of the service is kept in """
+	if not service:
+		sys.exit('\n  No service info found in file, logo templates are kept per service\n')
+	return os.path.join(refLibrary, service.upper())
+
+
+def logoCorner(folder):
+	""" Returns the corner of the frame the logo is searched in, from logo.json in the folder or logoBox """
+	if os.path.exists(os.path.join(folder, 'logo.json')):
+		with open(os.path.join(folder, 'logo.json')) as logoFile:
+			return json.load(logoFile)['box']
+	return logoBox
+
+
+def learnLogo(fh):
+	""" Learns the logo template of the service from the recording: the median of its logo corner over time,
+	    masked to the pixels that change least (the logo stays while the programme moves) """
+	folder = logoFolder(fh.service)
+	box = logoCorner(folder)
+	crops = np.concatenate(list(cornerFrames(fh.fullPath, box, logoLearnStep))).astype(np.float32)
+	template = np.median(crops, axis=0)
+	spread = crops.std(axis=0)
+	mask = spread <= np.percentile(spread, logoStable * 100)
+	os.makedirs(folder, exist_ok=True)
+	cv2.imwrite(os.path.join(folder, 'logo.png'), template.astype(np.uint8))
+	cv2.imwrite(os.path.join(folder, 'logo.mask.png'), mask.astype(np.uint8) * 255)
+	with open(os.path.join(folder, 'logo.json'), 'w') as logoFile:
+		json.dump({'box' : box, 'frames' : len(crops)}, logoFile)
+	print('    Learned logo of %s from %d frames, saved in "%s"' % (fh.service, len(crops), folder))
+
+
+def logoPresence(crops, template, mask):
+	""" Returns the normalized correlation of each crop with the template, over the pixels of the mask """
+	t = template[mask].astype(np.float32)
+	t = (t - t.mean()) / (t.std() + 1e-6)
+	c = crops.reshape(len(crops), -1)[:, mask.ravel()].astype(np.float32)
+	c = (c - c.mean(axis=1, keepdims=True)) / (c.std(axis=1, keepdims=True) + 1e-6)
+	return (c * t).mean(axis=1)
+
+
+def findAds(fh):
+	""" Scores the logo of the service in every second of the recording, stores the scores as a .logo.npy sidecar,
+	    and returns (start, stop) in seconds of every run of at least adMinLength without logo """
+	folder = logoFolder(fh.service)
+	if not os.path.exists(os.path.join(folder, 'logo.png')):
+		sys.exit('\n  No logo template found for %s, learn one with --learnLogo\n' % fh.service)
+	template = cv2.imread(os.path.join(folder, 'logo.png'), cv2.IMREAD_GRAYSCALE)
+	mask = cv2.imread(os.path.join(folder, 'logo.mask.png'), cv2.IMREAD_GRAYSCALE) > 127
+	started = time.time()
+	scores = np.concatenate([logoPresence(block, template, mask) for block in cornerFrames(fh.fullPath, logoCorner(folder), 1)])
+	np.save(fh.sidecar('.logo.npy'), scores.astype(np.float32))
+	print("\n  Scored the logo in %d seconds of video in %.1f seconds" % (len(scores), time.time() - started))
+	present = np.pad(scores > logoMinScore, 2, mode='edge')
+	present = np.lib.stride_tricks.sliding_window_view(present, 5).sum(axis=1) >= 3		# majority of 5 seconds, against flicker
+	gap = np.concatenate(([False], ~present, [False]))
+	edges = np.flatnonzero(np.diff(gap.astype(np.int8)))
+	return [(int(start), int(stop)) for start, stop in zip(edges[0::2], edges[1::2]) if stop - start >= adMinLength]
+
+
+def reportAds(fh, breaks):
+	""" Prints the ad breaks found and the parts of the recording between them """
+	print('\n  %d ad break(s) found:\n' % len(breaks))
+	for start, stop in breaks:
+		print('    %s - %s (%s)' % (secondsToTime(start), secondsToTime(stop), secondsToTime(stop - start)))
+	scores = np.load(fh.sidecar('.logo.npy'))
+	edges = [0] + [t for b in breaks for t in b] + [len(scores)]
+	parts = [(edges[n], edges[n + 1]) for n in range(0, len(edges), 2) if edges[n + 1] > edges[n]]
+	print('\n  Parts with logo : ' + ', '.join('%s-%s' % (secondsToTime(start), secondsToTime(stop)) for start, stop in parts))
+	print("     sudo ./recordingsTools.py '%s' --mux --cutout '%s'\n" % (fh.fullPath, ','.join('%s,%s' % (secondsToTime(start), secondsToTime(stop)) for start, stop in parts)))
+
+
+def dvrSchedule(fh):
+	""" Returns (start, stop) of the programme in seconds from the start of the recording, from its tvheadend DVR log, or None """
+	if not os.path.isdir(htsLogFiles):
+		return None
+	for f in os.listdir(htsLogFiles):
+		try:
+			with open(os.path.join(htsLogFiles, f)) as logFile:
+				data = json.load(logFile)
+		except (OSError, ValueError):
+			continue
+		for entry in data.get('files', []):
+			if os.path.splitext(entry.get('filename', ''))[0] == os.path.splitext(fh.fullPath)[0]:	# also after --updateDVR pointed it to the .mkv
+				recordingStart = entry.get('start', data['start'] - data.get('start_extra', 0) * 60)
+				return (data['start'] - recordingStart, data['stop'] - recordingStart)
+	return None
+
+
+def searchWindows(fh, fps, searchEnd):
+	""" Returns the (FROM, TO) frame ranges to search: subtitleMargin around the span of the subtitles (--subtitleHint),
+	    or dvrMargin around the programme start and stop in the DVR log.
+	    Without either FROM covers the whole recording and TO is None (searched from skipAfterFROM after the FROM match) """
+	if fh.subtitleSpan:
+		(start, stop), margin = fh.subtitleSpan, subtitleMargin
+		print("    Subtitles: programme estimated %s - %s, searching %s around each\n" % (secondsToTime(int(start)), secondsToTime(int(stop)), secondsToTime(margin)))
+	else:
+		schedule = dvrSchedule(fh) if not args.ignoreDvrLog else None
+		if schedule is None:
+			return (0, searchEnd), None
+		(start, stop), margin = schedule, dvrMargin
+		print("    DVR log: programme scheduled %s - %s, searching %s around each\n" % (secondsToTime(int(start)), secondsToTime(int(stop)), secondsToTime(margin)))
+	window = lambda seconds: (min(max(int((seconds - margin) * fps), 0), searchEnd), min(max(int((seconds + margin) * fps), 0), searchEnd))
+	return window(start), window(stop)
+
+
+def windowAfter(windowTO, frameFROM, searchEnd, skip=skipAfterFROM):
+	""" Returns the frame range to search for TO, once FROM was found at frameFROM """
+	if windowTO is None:
+		return (frameFROM + skip, searchEnd)
+	return (max(windowTO[0], frameFROM + 1), windowTO[1])
+
+
+def loadReferences(service, sigSize):
+	""" Returns {'FROM' : (ids, signatures, hashes, weights), 'TO' : (...), 'box' : region} for the service, or None if it has no complete set.
+	    Signatures are kept in a memory-mapped store in the service folder, rebuilt when its images, masks or regions change """
+	folder = os.path.join(refLibrary, service.upper()) if service else None
+	images = sorted(f for f in os.listdir(folder) if f.endswith('.jpg') and f.split('_')[0] in ('FROM', 'TO')) if folder and os.path.isdir(folder) else []	# sorting keeps each kind in one block
+	if not images:
+		return legacyReferences(sigSize)	# also when the folder only holds jingles or a logo
+	extras = [f for f in ['regions.json'] + [os.path.splitext(f)[0] + '.mask.png' for f in images] if os.path.exists(os.path.join(folder, f))]
+	stamp = {'size' : list(sigSize), 'images' : [[f, os.path.getmtime(os.path.join(folder, f))] for f in images + extras]}
+	meta = None
+	if os.path.exists(os.path.join(folder, 'signatures.json')):
+		with open(os.path.join(folder, 'signatures.json')) as metaFile:
+			meta = json.load(metaFile)
+	if meta is None or meta['stamp'] != stamp:
+		print('    Precomputing signatures of %d reference frame(s) for %s...' % (len(images), service))
+		sigs, hashes, weights, box = computeReferences(folder, images, sigSize)
+		np.save(os.path.join(folder, 'signatures.npy'), sigs)
+		if weights is not None:
+			np.save(os.path.join(folder, 'weights.npy'), weights)
+		meta = {'stamp' : stamp, 'ids' : images, 'hashes' : hashes, 'box' : box, 'weighted' : weights is not None}
+		with open(os.path.join(folder, 'signatures.json'), 'w') as metaFile:	# written last, so a partial store never validates
+			json.dump(meta, metaFile)
+	kinds = [refId.split('_')[0] for refId in meta['ids']]
+	sigs = np.load(os.path.join(folder, 'signatures.npy'), mmap_mode='r')
+	weights = np.load(os.path.join(folder, 'weights.npy'), mmap_mode='r') if meta['weighted'] else None
+	return groupReferences(meta['ids'], kinds, sigs, np.array(meta['hashes'], dtype=np.uint64), weights, meta['box'])
+
+
+def legacyReferences(sigSize):
+	""" Returns the single FROM/TO pair from refImageFROM.jpg and refImageTO.jpg in the current directory, if they exist """
+	if not os.path.exists("refImageFROM.jpg") or not os.path.exists("refImageTO.jpg"):
+		return None
+	ids = ["refImageFROM.jpg", "refImageTO.jpg"]
+	sigs, hashes, weights, box = computeReferences('.', ids, sigSize)
+	return groupReferences(ids, ['FROM', 'TO'], sigs, np.array(hashes, dtype=np.uint64), weights, box)
+
+
+def computeReferences(folder, ids, sigSize):
+	""" Returns (signatures, hashes, weights, box) of the reference images. Box is the region any of them compares,
+	    weights the mask of each in signature space (both None when every reference compares the whole frame) """
+	frames = [cv2.imread(os.path.join(folder, f)) for f in ids]
+	shape = frames[0].shape[:2]
+	masks = referenceMasks(folder, ids, shape)
+	box = compareRegion(masks, shape)
+	sigs = np.stack([makeSignature(img, sigSize, box) for img in frames])
+	weights = None
+	if any(mask is not None for mask in masks):
+		full = np.ones((sigSize[1], sigSize[0]), dtype=np.float32)
+		weights = np.stack([full if mask is None else cv2.resize(cropBox(mask, box), sigSize, interpolation=cv2.INTER_AREA) for mask in masks])
+	return sigs, [int(dHash(img)) for img in frames], weights, box
+
+
+def referenceMasks(folder, ids, shape):
+	""" Returns the mask (1 where compared) of each reference, from its crop in regions.json ("*" applies to all) and its <id>.mask.png.
+	    None means the whole frame is compared """
+	regions = {}
+	if os.path.exists(os.path.join(folder, 'regions.json')):
+		with open(os.path.join(folder, 'regions.json')) as regionFile:
+			regions = json.load(regionFile)
+	masks = []
+	for refId in ids:
+		mask = None
+		crop = regions.get(refId, regions.get('*', {})).get('crop')	# [x, y, width, height] in pixels of the reference image
+		if crop:
+			x, y, width, height = crop
+			mask = np.zeros(shape, dtype=np.float32)
+			mask[y:y + height, x:x + width] = 1
+		maskFile = os.path.join(folder, os.path.splitext(refId)[0] + '.mask.png')
+		if os.path.exists(maskFile):
+			binary = cv2.resize(cv2.imread(maskFile, cv2.IMREAD_GRAYSCALE), (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+			binary = (binary > 127).astype(np.float32)
+			mask = binary if mask is None else mask * binary
+		if mask is not None and not mask.any():
+			sys.exit('\n  Reference "%s" has an empty compare region, please check regions.json and its mask\n' % refId)
+		masks.append(mask)
+	return masks
+
+
+def compareRegion(masks, shape):
+	""" Returns the bounding box (as fractions of the frame) of all masks, or None if any reference compares the whole frame """
+	if any(mask is None for mask in masks):
+		return None
+	union = np.maximum.reduce(masks)
+	rows, cols = np.flatnonzero(union.any(axis=1)), np.flatnonzero(union.any(axis=0))
+	if not len(rows):
+		return None
+	return [cols[0] / float(shape[1]), rows[0] / float(shape[0]), (cols[-1] + 1) / float(shape[1]), (rows[-1] + 1) / float(shape[0])]
+
+
+def groupReferences(ids, kinds, sigs, hashes, weights, box):
+	""" Splits the references by kind, keeping each block of signatures (and weights) a view of the (memory-mapped) store """
+	refs = {'box' : box}
+	for kind in ('FROM', 'TO'):
+		if kind not in kinds:
+			return None
+		first, last = kinds.index(kind), len(kinds) - kinds[::-1].index(kind)
+		refs[kind] = (ids[first:last], sigs[first:last], hashes[first:last], None if weights is None else weights[first:last])
+	return refs
+
+
+def referencePath(service, kind, ext, legacy):
+	""" Returns the path of the next reference of the kind in the library folder of the service (legacy name in the current directory, if the service is unknown) """
+	if not service:
+		return legacy % kind + ext
+	folder = os.path.join(refLibrary, service.upper())
+	os.makedirs(folder, exist_ok=True)
+	number = 1
+	while os.path.exists(os.path.join(folder, '%s_%02d%s' % (kind, number, ext))):
+		number += 1
+	return os.path.join(folder, '%s_%02d%s' % (kind, number, ext))
+
+
+def saveReference(service, kind, img):
+	""" Saves a new reference frame in the library folder of the service (or the current directory, if the service is unknown) """
+	fileName = referencePath(service, kind, '.jpg', 'refImage%s')
+	cv2.imwrite(fileName, img)
+	os.chmod(fileName, 0o777)
+	print('    Saved reference frame "%s"' % fileName)
+
+
+def parseSize(raw):
+	""" Parses a 'WIDTHxHEIGHT' string to a (width, height) tuple """
+	try:
+		width, height = raw.lower().split('x')
+		return (int(width), int(height))
+	except ValueError:
+		sys.exit('\nMalformed size string "%s": must be given as WIDTHxHEIGHT ( e.g. "64x36")\n' % raw)
+
+
+def findCutPoints(fh, refs, sigSize):
+	""" Searches the recording for frames matching the FROM and TO references, in the scan mode selected.
+	    Returns {'FROM' : (timestamp, difference, reference), 'TO' : (...)}, or None if they were not both found """
+	cached = loadCut(fh) if not args.rescan else None
+	if cached:
+		print("\n  Cut points were found in an earlier run (--rescan searches again)")
+		return {kind : (cached[kind]['timestamp'], cached[kind]['difference'], cached[kind]['reference']) for kind in ('FROM', 'TO')}
+	if args.subtitleHint:
+		hint = subtitleSpan(fh)
+		if hint and hint[2] >= subtitleConfidence:
+			print("\n  Subtitles give the programme with confidence %.2f, frame matching skipped" % hint[2])
+			return {'FROM' : (secondsToTime(float(hint[0])), 1 - hint[2], 'subtitles'), 'TO' : (secondsToTime(float(hint[1])), 1 - hint[2], 'subtitles')}
+		fh.subtitleSpan = hint[:2] if hint else None
+	source = openSource(fh.fullPath, args.decoder, args.grabScan, gray=True)	# Open the video file, matching only needs luma
+	dense = source if args.grabScan or args.decoder != 'opencv' else openSource(fh.fullPath, args.decoder, True, gray=True)	# the index and refining read whole ranges, sequentially whatever --grabScan says
+	fps = int(source.fps)					# Get the frames per second
+	frame_count = source.frameCount				# Get the total numer of frames in the video.
+	print("\n  %d FROM and %d TO reference frame(s) exist, searching...\n" % (len(refs['FROM'][0]), len(refs['TO'][0])))
+	fpsExact = source.fps
+	idsFROM, hashesFROM = refs['FROM'][0], refs['FROM'][2]
+	idsTO, hashesTO = refs['TO'][0], refs['TO'][2]
+	if refs['box']:
+		print("    Comparing only the region %d%%-%d%% x %d%%-%d%% of the frames\n" % tuple(100 * v for v in (refs['box'][0], refs['box'][2], refs['box'][1], refs['box'][3])))
+	searchEnd = int(frame_count - fps)
+	windowFROM, windowTO = searchWindows(fh, fps, searchEnd)
+	if args.useIndex:
+		hashes = loadHashIndex(fh)
+		if hashes is None:
+			print("    No valid hash index found, indexing recording (once)...")
+			hashes = buildHashIndex(fh, dense, fps, frame_count)
+		distFROM = np.array([hammingDistances(hashes, refHash) for refHash in hashesFROM])	# (references, seconds)
+		distTO   = np.array([hammingDistances(hashes, refHash) for refHash in hashesTO])
+		seconds = np.arange(len(hashes)) * fps		# first frame of each indexed second
+		def indexMatch(kind, dist, start, stop, limit):	# first indexed second in the window whose refined difference is within the limit
+			for second in np.flatnonzero((dist.min(axis=0) <= hashMaxDistance) & (seconds >= start) & (seconds < stop)):
+				ref = int(dist[:, second].argmin())
+				frame, difference = refineMatch(dense, refs, kind, ref, sigSize, int(second) * fps, fps)
+				if difference is not None and difference < limit:
+					return int(second), ref, frame, difference
+				print("    %s hash match at %s rejected (difference %s)" % (kind, secondsToTime(int(second)), difference))
+			return None
+		matchFROM = indexMatch('FROM', distFROM, windowFROM[0], windowFROM[1], diffMinFROM)
+		if matchFROM:
+			secondFROM, refFROM, frameFROM, differenceFROM = matchFROM
+			start, stop = windowAfter(windowTO, frameFROM, searchEnd)
+			matchTO = indexMatch('TO', distTO, start, stop, diffMinTO)
+			if matchTO:
+				secondTO, refTO, frameTO, differenceTO = matchTO
+				print("    Match was found at : ", secondsToTime(frameFROM / fpsExact), "(%s, distance %d)" % (idsFROM[refFROM], distFROM[refFROM, secondFROM]))
+				print("    Match was found at : ", secondsToTime(frameTO / fpsExact), "(%s, distance %d)" % (idsTO[refTO], distTO[refTO, secondTO]))
+				return {'FROM' : (secondsToTime(frameFROM / fpsExact), differenceFROM, idsFROM[refFROM]), 'TO' : (secondsToTime(frameTO / fpsExact), differenceTO, idsTO[refTO])}
+		print("\n No match was found in the hash index, sorry...\n")
+		return None
+	step = max(int((float(args.coarseStep[0]) if args.coarseStep else coarseStep) * fps), 1)
+	if args.keyframeScan:
+		matchFROM, matchTO = keyframeScan(fh.fullPath, refs, sigSize, fps, windowFROM, windowTO, searchEnd)
+		if matchFROM and matchTO:
+			# refine around each keyframe with the selected decoder, which also cross-checks the match
+			frameFROM, differenceFROM = refineMatch(dense, refs, 'FROM', matchFROM[1], sigSize, int(matchFROM[0] * fpsExact), fps)
+			frameTO, differenceTO = refineMatch(dense, refs, 'TO', matchTO[1], sigSize, int(matchTO[0] * fpsExact), fps)
+			checked = True
+			for name, keyframe, frame, difference, limit in ((idsFROM[matchFROM[1]], matchFROM[0], frameFROM, differenceFROM, diffMinFROM), (idsTO[matchTO[1]], matchTO[0], frameTO, differenceTO, diffMinTO)):
+				check = 'OK' if difference is not None and difference < limit else 'FAILED'
+				checked = checked and check == 'OK'
+				print("    %s keyframe at %s, %s best frame at %s (difference %s) : cross-check %s" % (name, secondsToTime(keyframe), source.name, secondsToTime(frame / fpsExact), difference, check))
+			if checked:
+				return {'FROM' : (secondsToTime(frameFROM / fpsExact), differenceFROM, idsFROM[matchFROM[1]]), 'TO' : (secondsToTime(frameTO / fpsExact), differenceTO, idsTO[matchTO[1]])}
+			print("\n The keyframe match was not confirmed, checking frames instead...\n")
+		else:
+			print("\n All keyframes where checked without further matches, sorry...\n")
+			return None
+	if args.workers and args.workers[0] > 1:
+		matchFROM, matchTO = parallelScan(fh.fullPath, args.decoder, windowFROM, windowTO, searchEnd, step, refs, sigSize, args.workers[0])
+		if matchFROM and matchTO:
+			frameFROM, differenceFROM = refineMatch(dense, refs, 'FROM', matchFROM[2], sigSize, matchFROM[0], step)
+			frameTO, differenceTO = refineMatch(dense, refs, 'TO', matchTO[2], sigSize, matchTO[0], step)
+			print("    Match was found at : ", secondsToTime(frameFROM / fpsExact), "(%s, difference %s)" % (idsFROM[matchFROM[2]], differenceFROM))
+			print("    Match was found at : ", secondsToTime(frameTO / fpsExact), "(%s, difference %s)" % (idsTO[matchTO[2]], differenceTO))
+			return {'FROM' : (secondsToTime(frameFROM / fpsExact), differenceFROM, idsFROM[matchFROM[2]]), 'TO' : (secondsToTime(frameTO / fpsExact), differenceTO, idsTO[matchTO[2]])}
+		print("\n All frames where checked without further matches, sorry...\n")
+		return None
+	frameToCheck, scanStop = windowFROM
+	kindSEARCH = 'FROM'
+	found = {}
+	diffMin = diffMinFROM
+	scanMode = source.name + (' seek' if source.name == 'opencv' and not args.grabScan else '')
+	scanStarted = time.time()
+	framesScanned = 0
+	# check a frame every coarse step untill match is found, then refine it frame by frame
+	while frameToCheck < scanStop:
+		for frameToCheck, img in source.frames(frameToCheck, scanStop, step):
+			timeMark = str(secondsToTime(int(frameToCheck / fps)))
+			print("    Checking frame number " + ((10 - len(timeMark)) * " ") + timeMark + " : Match to ref is ", end="")
+			difference, ref = bestReference(refs[kindSEARCH][1], makeSignature(img, sigSize, refs['box']), refs[kindSEARCH][3], diffMin)
+			print('%.2f' % difference if difference < diffMin else 'above %s' % diffMin)
+			framesScanned += step
+			if difference < diffMin:
+				frameMatch, difference = refineMatch(dense, refs, kindSEARCH, ref, sigSize, frameToCheck, step)
+				timestamp = secondsToTime(frameMatch / fpsExact)
+				print("Match was found at : ", timestamp)
+				print("Reference          : ", refs[kindSEARCH][0][ref])
+				print("Difference         : ", difference)
+				found[kindSEARCH] = (timestamp, difference, refs[kindSEARCH][0][ref])
+				if kindSEARCH == 'FROM':
+					kindSEARCH = 'TO'	# continue looking for second match
+					diffMin = diffMinTO
+					frameToCheck, scanStop = windowAfter(windowTO, frameMatch, searchEnd)
+					break		# restart reader in the TO window (refining may have moved the capture)
+				else:
+					reportScanSpeed(scanMode, framesScanned, scanStarted)
+					return found
+		else:
+			break	# reader ran out of frames
+	reportScanSpeed(scanMode, framesScanned, scanStarted)
+	print("\n All frames where checked without further matches, sorry...\n")
+	return None
+
+
+def cutEntries(found):
+	""" Returns the cut points found, {'FROM' : (timestamp, difference, reference), 'TO' : (...)}, as JSON objects """
+	return {kind : {'timestamp' : timestamp, 'difference' : None if difference is None else float(difference), 'reference' : reference} for kind, (timestamp, difference, reference) in found.items()}
+
+
+def saveCut(fh, found):
+	""" Stores the cut points found in a sidecar of the recording """
+	cut = {'stamp' : fh.stamp()}
+	cut.update(cutEntries(found))
+	with open(fh.sidecar('.cut.json'), 'w') as cutFile:
+		json.dump(cut, cutFile, indent=4)
+
+
+def loadCut(fh):
+	""" Returns the cut points cached for the recording, or None if there are none or the recording has changed """
+	if not os.path.exists(fh.sidecar('.cut.json')):
+		return None
+	with open(fh.sidecar('.cut.json')) as cutFile:
+		cut = json.load(cutFile)
+	if cut.get('stamp') != fh.stamp():
+		return None
+	return cut
+
+
+def reportCutout(fh, found):
+	""" Caches the cut points found and prints the command that extracts the programme between them """
+	saveCut(fh, found)
+	print("\n SUCCES! Both timestamps where found.\n")
+	print(" Run this command to extract video (--mux alone uses the cached timestamps):")
+	print("     sudo ./recordingsTools.py '%s' --mux --cutout '%s,%s'\n" % (fh.fullPath, found['FROM'][0], found['TO'][0]))
+
+
+def batchJob(job):
+	""" Pool job of --batch: searches one recording with its output discarded, returns (fileName, found, error, seconds) """
+	fileName, service, sigSize = job
+	started = time.time()
+	found, error = None, None
+	args.workers = None		# pool processes can not start pools of their own
+	try:
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			fh = fileClass(fileName)
+			fh.service = service
+			refs = loadReferences(service, sigSize)
+			if refs:
+				found = findCutPoints(fh, refs, sigSize)
+				if found:
+					saveCut(fh, found)
+			else:
+				error = 'no reference frames for ' + (service or 'the current directory')
+	except (Exception, SystemExit) as e:		# one broken recording must not stop the batch
+		error = str(e).strip() or type(e).__name__
+	return fileName, found, error, time.time() - started
+
+
+def batchFindStopEnd(fileNames, summaryFile):
+	""" Finds the cut points of all recordings in a pool of processes (one per CPU, or --workers), prints each result
+	    as it completes and a summary table at the end, which is also written to summaryFile as JSON """
+	sigSize = parseSize(args.signatureSize[0]) if args.signatureSize else signatureSize
+	jobs, broken = [], []
+	for f in fileNames:
+		fh = fileClass(f)
+		if args.checkStream and fh.ext == '.ts' and not reportTS(fh.fileName, scanTS(fh.fullPath)):
+			broken.append((fh.fullPath, None, 'broken stream', 0.0))	# listed in the summary, not searched
+			continue
+		if not args.noCheckMedia:
+			fh.checkMedia()
+		jobs.append((fh.fullPath, fh.service, sigSize))
+	for service in set(job[1] for job in jobs):
+		loadReferences(service, sigSize)	# precompute reference signatures once, before the processes share them
+	workers = max(min(args.workers[0] if args.workers else os.cpu_count(), len(jobs)), 1)
+	print('\n  Searching %d recording(s) in %d processes...\n' % (len(jobs), workers))
+	results = []
+	started = time.time()
+	with multiprocessing.get_context('fork').Pool(workers) as pool:
+		for fileName, found, error, seconds in pool.imap_unordered(batchJob, jobs):
+			results.append((fileName, found, error, seconds))
+			status = found['FROM'][0] + ' - ' + found['TO'][0] if found else (error or 'no match')
+			print('    [%d/%d] %s : %s (%.1f s)' % (len(results), len(jobs), os.path.basename(fileName), status, seconds), flush=True)
+	results = sorted(results + broken)
+	width = max([len(os.path.basename(r[0])) for r in results] + [4])
+	print('\n    ' + 'File'.ljust(width) + ' | FROM         | TO           | Seconds')
+	print('    ' + '-' * width + '-+--------------+--------------+--------')
+	for fileName, found, error, seconds in results:
+		cut = found['FROM'][0].ljust(12) + ' | ' + found['TO'][0].ljust(12) if found else (error or 'no match').ljust(27)
+		print('    %s | %s | %7.1f' % (os.path.basename(fileName).ljust(width), cut, seconds))
+	print('\n  Found cut points in %d of %d recording(s) in %.1f seconds' % (sum(1 for r in results if r[1]), len(results), time.time() - started))
+	with open(summaryFile, 'w') as summary:
+		json.dump([dict({'file' : fileName, 'error' : error, 'seconds' : round(seconds, 1)}, **(cutEntries(found) if found else {})) for fileName, found, error, seconds in results], summary, indent=4)
+	print('  Summary written to "' + summaryFile + '"')
+
+
+def analyzeRecording(fh, names):
+	""" Decodes the recording once, handing each frame to the analyzers named that want it, returns {name : results}.
+	    Prints the CPU time spent decoding and in each analyzer """
+	source = openSource(fh.fullPath, args.decoder, True, gray=True)	# one forward pass
+	active = [analyzers[name](fh, source.fps, source.frameCount) for name in names]
+	step = math.gcd(*[a.step for a in active])		# the grid of frames any analyzer needs
+	start = min(a.start for a in active) // step * step
+	cpu = dict.fromkeys(names, 0.0)
+	started = time.time()
+	decodeStarted = time.process_time()
+	for frameNo, img in source.frames(start, source.frameCount, step):
+		for a in active:
+			if frameNo % a.step == 0 and frameNo >= a.start:
+				analyzerStarted = time.process_time()
+				a.frame(frameNo, img)
+				cpu[a.name] += time.process_time() - analyzerStarted
+	decodeCpu = time.process_time() - decodeStarted - sum(cpu.values())
+	source.release()
+	results = {}
+	for a in active:
+		analyzerStarted = time.process_time()
+		results[a.name] = a.finish()
+		cpu[a.name] += time.process_time() - analyzerStarted
+	reportScanSpeed('pipeline', source.frameCount - start, started)
+	print('  CPU seconds: decode %.1f, ' % decodeCpu + ', '.join('%s %.1f' % (name, cpu[name]) for name in names) + '\n')
+	for a in active:
+		a.report(results[a.name])
+	return results
+
+
+def reportScanSpeed(mode, frames, started):
+	""" Prints how many frames of video the scan covered per second, to compare scan modes """
+	elapsed = max(time.time() - started, 0.001)
+	print("\n  Scanned %d frames in %.1f seconds (%.1f frames/sec, %s mode)" % (frames, elapsed, frames / elapsed, mode))
+
+
 # --- Main ---------------------------------------------------------------------------------------
 
 #check parameters
@@ -133,7 +1757,7 @@ parser.add_argument("-e", "--extractSubtitles",	action="store_true",	help="Extra
 parser.add_argument("-s", "--showCommand",	action="store_true",	help="Prints the command to be executed and exits")
 parser.add_argument("-d", "--delete",		action="store_true",	help="Deletes all files after any operation")
 parser.add_argument("-u", "--updateDVR",	action="store_true",	help="Update tvheadend-files to use .MKV-files")
-parser.add_argument("-c", "--cutout",		action="store",		help="Only encode from and to specific timemarks ('hh:mm:ss,hh:mm:ss')", type=str, nargs=1)
+parser.add_argument("-c", "--cutout",		action="store",		help="Only encode from and to specific timemarks ('hh:mm:ss[.mmm],hh:mm:ss[.mmm]'), more pairs keep more ranges in one encode", type=str, nargs=1)
 parser.add_argument("-n", "--noCheckMedia",	action="store_true",	help="Do not check file info")
 parser.add_argument("-p", "--noSetPermissions",	action="store_true",	help="Do not change file permissions")
 parser.add_argument("-i", "--checkExt",		action="store_true",	help="Checks that external programs exist")
@@ -141,6 +1765,28 @@ parser.add_argument("-m", "--mux",		action="store_true",	help="Encodes file to a
 parser.add_argument("-k", "--copy",		action="store_true",	help="Join files into mkv-container (copy)")
 parser.add_argument("-f", "--forceLanguage",	action="store",		help="Force encoded file to set subtitle language to <FORCELANGUAGE>", type=str, nargs=1),
 parser.add_argument("-q", "--findStopEnd",	action="store_true",	help="Find timemarks for cutout, based on frame recognition")
+parser.add_argument("-Q", "--batch",		action="store_true",	help="Find timemarks for all files (and recordings in directories) given, in a process per CPU, and write a summary (see --summary)")
+parser.add_argument("-S", "--summary",		action="store",		help="JSON file the summary of --batch is written to (default cutPoints.json)", type=str, nargs=1, default=['cutPoints.json'])
+parser.add_argument("-a", "--addReferences",	action="store_true",	help="Extract another FROM/TO pair of reference frames for the service of the recording")
+parser.add_argument("-z", "--signatureSize",	action="store",		help="Size of the luma signatures compared when matching frames ('WIDTHxHEIGHT', default 64x36)", type=str, nargs=1)
+parser.add_argument("-x", "--useIndex",		action="store_true",	help="Find timemarks in the per-second hash index of the recording (built on first use) instead of decoding it")
+parser.add_argument("-o", "--coarseStep",	action="store",		help="Seconds between frames checked before a match is refined frame by frame (default 5)", type=str, nargs=1)
+parser.add_argument("-w", "--workers",		action="store",		help="Scan the recording in <WORKERS> parallel processes (e.g. 16)", type=int, nargs=1)
+parser.add_argument("-y", "--keyframeScan",	action="store_true",	help="Scan keyframes only (ffmpeg -skip_frame nokey), then refine and cross-check matches with OpenCV")
+parser.add_argument("-T", "--subtitleHint",	action="store_true",	help="Estimate the programme from the timing of its teletext subtitles (extracted first): proposes a cutout, and with --findStopEnd narrows the search to it, or skips frame matching when confident")
+parser.add_argument("-R", "--rescan",		action="store_true",	help="Search the recording again, even if cut points were cached by an earlier --findStopEnd")
+parser.add_argument("-L", "--ignoreDvrLog",	action="store_true",	help="Search the whole recording, not only around the programme start/stop in the tvheadend DVR log")
+parser.add_argument("-g", "--grabScan",		action="store_true",	help="Scan the recording forward once (grab/retrieve) instead of seeking to each sampled frame (opencv decoder)")
+parser.add_argument("-b", "--decoder",		action="store",		help="Decoder backend used for frame access (opencv, ffmpeg or pyav, default opencv)", type=str, default='opencv', choices=list(frameSources))
+parser.add_argument("-j", "--findJingles",	action="store_true",	help="Find timemarks for cutout from the FROM/TO audio jingles of the service, by STFT peak fingerprints")
+parser.add_argument("-J", "--addJingles",	action="store_true",	help="Cut FROM/TO audio jingles of the service from the recording")
+parser.add_argument("-K", "--learnLogo",	action="store_true",	help="Learn the channel logo of the service from the recording (corner set by logo.json in its reference folder)")
+parser.add_argument("-D", "--findAds",		action="store_true",	help="Track the channel logo second by second, and report runs without it as ad breaks")
+parser.add_argument("-G", "--findGaps",		action="store_true",	help="Find black and silent gaps (programme and ad break boundaries) from downscaled luma and low-rate audio, no reference frames needed")
+parser.add_argument("-A", "--analyze",		action="store",		help="Decode the recording once, running all analyzers listed (comma separated: %s)" % ', '.join(analyzers), type=str, nargs=1)
+parser.add_argument("-P", "--probeStreams",	action="store_true",	help="Reports service, PIDs, stream types and languages read from the transport stream tables of the recording and exits")
+parser.add_argument("-V", "--checkStream",	action="store_true",	help="Scans .ts recordings for reception errors (sync, transport errors, continuity, PCR gaps) first, and skips broken ones")
+parser.add_argument("-B", "--benchmarkDecoders",	action="store_true",	help="Reports frames/sec, CPU time and peak RSS of each decoder backend on the recording and exits")
 args = parser.parse_args()
 
 # adjust arguments selected				<------------- Probably better to inform user that switches a mutualy exclusive
@@ -148,7 +1794,10 @@ if args.showCommand: args.noCheckMedia = True
 if args.extractSubtitles: args.noCheckMedia = False
 if (len(sys.argv) < 2 or not os.path.exists(sys.argv[1])) and not args.updateDVR:
 	sys.exit('\n  Must get existing file as first argument\n')
-for f in  args.files:
+for f in list(args.files):	# directories are replaced by the recordings in them
+	if os.path.isdir(f):
+		args.files[args.files.index(f):args.files.index(f) + 1] = [os.path.join(f, n) for n in sorted(os.listdir(f)) if os.path.splitext(n)[1] in validFormats]
+for f in list(args.files):
 	if not os.path.splitext(f)[1] in validFormats:
 		args.files.pop( args.files.index(f) )
 		print('    File "' + f + '" was removed from selected files because of invalid extension')
@@ -205,6 +1854,16 @@ if args.checkExt:
 		print(' does not seem to be installed. Install with "apt install -y ccextractor"')
 	else:
 		print(' OK')
+	print('    ffmpeg...', end='')
+	if subprocess.call(['which', 'ffmpeg'], stdout=subprocess.PIPE):
+		print(' does not seem to be installed. Install with "apt install -y ffmpeg"')
+	else:
+		print(' OK')
+	print('    mkvmerge...', end='')
+	if subprocess.call(['which', 'mkvmerge'], stdout=subprocess.PIPE):
+		print(' does not seem to be installed (ffmpeg joins multi-range cutouts instead). Install with "apt install -y mkvtoolnix"')
+	else:
+		print(' OK')
 	print('    HandbrakeCLI...', end='')
 	if subprocess.call(['which', 'HandBrakeCLI'], stdout=subprocess.PIPE):
 		print(' does not seem to be installed. Install with "apt install -y handbrake-cli"')
@@ -217,6 +1876,25 @@ if args.checkExt:
 		print('    pymediainfo... does not seem to be installed. Install with "pip3 install pymediainfo"')
 	sys.exit('\n')
 
+#find timemarks of all recordings in a pool of processes
+if args.batch:
+	if os.path.splitext(args.summary[0])[1].lower() in validFormats or os.path.abspath(args.summary[0]) in [os.path.abspath(f) for f in args.files]:
+		sys.exit('\n  Summary file "%s" looks like a recording, refusing to overwrite it\n' % args.summary[0])
+	batchFindStopEnd(args.files, args.summary[0])
+	sys.exit('\n')
+
+#benchmark decoder backends
+if args.benchmarkDecoders:
+	for f in args.files:
+		benchmarkDecoders(f)
+	sys.exit('\n')
+
+#list the streams of transport stream recordings
+if args.probeStreams:
+	for f in args.files:
+		reportStreams(f)
+	sys.exit('\n')
+
 # creating fileObject(s)
 fileHandles = []
 for f in args.files:
@@ -224,13 +1902,7 @@ for f in args.files:
 	fh.checkSrt()
 	if not args.noCheckMedia:
 		print('\n  Collecting media-info from "' + fh.fileName + '":')
-		mediaInfo = {}
-		fileInfo = json.loads(MediaInfo.parse(fh.fullPath).to_json())
-		for track in fileInfo['tracks']:
-			mediaInfo[track['track_type']] = track
-		# cherrypick info
-		fh.subLang = mediaInfo['Other']['language']    if 'Other' in mediaInfo else False
-		fh.service = mediaInfo['Menu']['service_name'] if 'Menu' in mediaInfo else False
+		fh.checkMedia()
 
 	# show collected data
 	srtLength = 0 if fh.srtFiles == [] else len(fh.srtFiles[0][0]) + len(fh.srtFiles[0][1]) + 3
@@ -249,54 +1921,60 @@ for f in args.files:
 	if fh.subLang:
 		print('    | Language         : ' + fh.subLang,  ((maxLength - len(fh.subLang)) * ' ') + '|')
 	print('    +' + ('-' * (maxLength + 21)) + '+')
+	if args.checkStream and fh.ext == '.ts' and not reportTS(fh.fileName, scanTS(fh.fullPath)):
+		print('    Skipping "%s"' % fh.fileName)
+		continue
 	cmdLineSrt = False
+	if args.subtitleHint and not args.findStopEnd:
+		hint = subtitleSpan(fh)
+		if hint:
+			print("\n  Subtitles suggest (confidence %.2f):" % hint[2])
+			print("     sudo ./recordingsTools.py '%s' --mux --cutout '%s,%s'\n" % (fh.fullPath, secondsToTime(float(hint[0])), secondsToTime(float(hint[1]))))
+		sys.exit()
+	if args.findJingles:
+		clips = jingleFiles(fh.service)
+		if not clips['FROM'] or not clips['TO']:
+			sys.exit('\n  No FROM and TO jingles found for %s, add them with --addJingles\n' % (fh.service or 'the current directory'))
+		found = jingleScan(fh, clips)
+		if found:
+			reportCutout(fh, found)
+		else:
+			print("\n No jingle match was found, sorry...\n")
+		sys.exit()
+	if args.addJingles:
+		for kind in ('FROM', 'TO'):
+			raw = input('\n    Type start and end of the %s jingle ("hh:mm:ss[.mmm],hh:mm:ss[.mmm]") : ' % kind)
+			if ',' not in raw:
+				sys.exit('\nMalformed jingle string: must contain two timemarks, seperated by "," ( e.g. "hh:mm:ss,hh:mm:ss")\n')
+			fra, til = raw.split(',')
+			saveJingle(fh.service, kind, fh.fullPath, timeToSeconds(fra), timeToSeconds(til))
+		sys.exit("Jingles were created without error")
+	if args.learnLogo:
+		learnLogo(fh)
+		sys.exit()
+	if args.findAds:
+		reportAds(fh, findAds(fh))
+		sys.exit()
+	if args.findGaps:
+		reportGaps(fh, blackSilentGaps(fh.fullPath))
+		sys.exit()
+	if args.analyze:
+		names = args.analyze[0].split(',')
+		for name in names:
+			if name not in analyzers:
+				sys.exit('\n  Unknown analyzer "%s", choose from: %s\n' % (name, ', '.join(analyzers)))
+		analyzeRecording(fh, names)
+		sys.exit()
 	if args.findStopEnd: #		Tester med:	13:08,1:02:24
-		cap = cv2.VideoCapture(args.files[0])			# Open the video file
-		fps = int(cap.get(cv2.CAP_PROP_FPS))			# Get the frames per second
-		frame_count= cap.get(cv2.CAP_PROP_FRAME_COUNT)		# Get the total numer of frames in the video.
-		if os.path.exists("refImageFROM.jpg") and os.path.exists("refImageTO.jpg"):
-			print("\n  Both reference images exist, searching...\n")
-			imgFROM = cv2.imread(f"refImageFROM.jpg")
-			imgTO   = cv2.imread(f"refImageTO.jpg")
-			imgFROM = cv2.cvtColor(imgFROM, cv2.COLOR_BGR2GRAY)
-			imgTO   = cv2.cvtColor(imgTO, cv2.COLOR_BGR2GRAY)
-			h, w = imgFROM.shape
-			frameToCheck = 0
-			imgSEARCH = imgFROM
-			firstFound = False
-			diffMin = 1.1
-			# check each frame untill match is found
-			while frameToCheck < frame_count - fps:
-				time = str(secondsToTime(int(frameToCheck / fps)))
-				print("    Checking frame number " + ((10 - len(time)) * " ") + time + " : Match to ref is ", end="")
-				cap.set(cv2.CAP_PROP_POS_FRAMES, frameToCheck)
-				ret, img = cap.read()
-				frameImage = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-				diff = cv2.subtract(imgSEARCH, frameImage)
-				err = np.sum(diff**2)
-				difference = err/(float(h*w))
-				print(difference)
-				# update frame count, in effect, check every second
-				frameToCheck += fps
-				if difference < diffMin:
-					seconds = int(frameToCheck / fps)
-					print("Match was found at : ", secondsToTime(seconds))
-					print("Difference         : ", difference)
-					if not firstFound:
-						firstFound = True
-						timestampFROM = secondsToTime(seconds)
-						imgSEARCH = imgTO	# continue looking for second match
-						diffMin = 0.4
-						frameToCheck += 3000 * 45
-					else:
-						timestampTO = secondsToTime(seconds)
-						print("\n SUCCES! Both timestamps where found.\n")
-						print(" Run this command to extract video:")
-						print("     sudo ./recordingsTools.py '%s' --mux --cutout '%s,%s'\n" % (args.files[0], timestampFROM, timestampTO))
-						sys.exit()
-			sys.exit("\n All frames where checked without further matches, sorry...\n")
+		sigSize = parseSize(args.signatureSize[0]) if args.signatureSize else signatureSize
+		refs = loadReferences(fh.service, sigSize)
+		if refs and not args.addReferences:
+			found = findCutPoints(fh, refs, sigSize)
+			if found:
+				reportCutout(fh, found)
+			sys.exit()
 		else:
-			print("\n  Reference images do not exist\n")
+			print("\n  Reference images do not exist\n" if not refs else "\n  Adding reference images for %s\n" % (fh.service or 'the current directory'))
 			raw = input('\n    Type start and end frames ("hh:mm:ss,hh:mm:ss") : ')
 			# parse string given
 			if ',' in raw:
@@ -306,22 +1984,15 @@ for f in args.files:
 			else:
 				sys.exit('\nMalformed cutout string: must contain two timemarks, seperated by "," ( e.g. "hh:mm:ss,hh:mm:ss")\n')
 			# extract two reference images and then end program
+			source = openSource(fh.fullPath, args.decoder)
+			fps = int(source.fps)					# Get the frames per second
+			frame_count = source.frameCount				# Get the total numer of frames in the video.
 			fraFrame = int(fraSeconds * fps)
 			tilFrame = int(tilSeconds * fps)
-			# save first frame
-			cap.set(cv2.CAP_PROP_POS_FRAMES, fraFrame)
-			ret, frame = cap.read()
-			cv2.imwrite(f"refImageFROM.jpg", frame)
-			# save second frame
-			cap.set(cv2.CAP_PROP_POS_FRAMES, tilFrame)
-			ret, frame = cap.read()
-			cv2.imwrite(f"refImageTO.jpg", frame)
-			# cleanup and end
-			os.chmod("refImageFROM.jpg", 0o777)
-			os.chmod("refImageTO.jpg", 0o777)
-			cap.release()
-			cv2.destroyAllWindows()
-			print(cap, fps, frame_count)
+			saveReference(fh.service, 'FROM', source.frame(fraFrame))
+			saveReference(fh.service, 'TO', source.frame(tilFrame))
+			source.release()
+			print(source.name, fps, frame_count)
 			sys.exit("Reference frames were crated without error")
 	elif args.extractSubtitles:
 		if not fh.service:
@@ -336,31 +2007,52 @@ for f in args.files:
 			print('    Subtitle extracted');
 			fh.checkSrt()
 
-	# move time in subtitles and slice file, if requested
+	# move time in subtitles and slice file, if requested (or cut where --findStopEnd found the programme)
+	cached = loadCut(fh) if args.mux and not args.cutout else None
+	joinCmds, inputFile, tempFiles, srtFiles = [], fh.fullPath, [], fh.srtFiles
 	if args.cutout:
-		raw = args.cutout[0]
-		# parse string given
-		if ',' in raw:
-			fra, til = raw.split(',')
-		else:
-			sys.exit('\nMalformed cutout string: must contain two timemarks, seperated by "," ( e.g. "hh:mm:ss,hh:mm:ss")\n')
-		cutout = extJobs[2.2] % calculateCutting(fra, til)
+		ranges = parseCutout(args.cutout[0])
+		if len(ranges) == 1:
+			cutout = extJobs[2.2] % calculateCutting(*ranges[0])
+		else:	# several ranges are joined by stream copy first, then encoded once
+			cutout = ''
+			joinCmds, inputFile, tempFiles = joinCommands(fh, ranges)
+			srtFiles = [[fh.sidecar('.retimed%d.srt' % n), language] for n, (f, language) in enumerate(fh.srtFiles)]	# written before encoding
+			tempFiles += [f for f, language in srtFiles]
+	elif cached:
+		print('\n  Using cut points cached by --findStopEnd : ' + cached['FROM']['timestamp'] + ' - ' + cached['TO']['timestamp'])
+		cutout = extJobs[2.2] % calculateCutting(cached['FROM']['timestamp'], cached['TO']['timestamp'])
+	else:
+		cutout = ''
 	if args.mux:
 		# calculate argument
-		srtArg = extJobs[2.1] if fh.srtFiles else ''
-		for count, f in enumerate(fh.srtFiles):
+		srtArg = extJobs[2.1] if srtFiles else ''
+		for count, f in enumerate(srtFiles):
 			srtArg += extJobs[2.11] % (count, f[0], f[1])
-		cmdLine = extJobs[2] % (srtArg, fh.fullOutFile, fh.fullPath, cutout)
+		cmdLine = extJobs[2] % (srtArg, fh.fullOutFile, inputFile, cutout)
 		if args.showCommand:
 			if cmdLineSrt:
 				print('\n  Extraction-command to be executed: ' + cmdLineSrt)
+			for joinCmd in joinCmds:
+				print('  Join-command to be executed      : ' + joinCmd)
 			print('  Compresion-command to be executed: ' + cmdLine)
 			print('\n  All done!\n')
 			sys.exit()
 		else:
+			if joinCmds:
+				print('\n  Joining %d ranges of "%s" (stream copy):' % (len(ranges), fh.fileName))
+				for joinCmd in joinCmds:
+					runProcess(joinCmd)
+				if not os.path.exists(inputFile):
+					sys.exit('\n  Joining the ranges did not produce "%s", not encoding\n' % inputFile)
+				for (f, language), (retimed, language) in zip(fh.srtFiles, srtFiles):
+					print('    %s : %d cue(s) kept' % (f, retimeSrt(os.path.join(fh.path, f), ranges, retimed)))
 			print('\n  Encoding to "' + fh.fileName + '":')
 			print(cmdLine)
 			runProcess(cmdLine)
+			for f in tempFiles:
+				if os.path.exists(f):
+					os.remove(f)
 	elif args.copy:
 		srtArg = ['', '', '']
 		for nr, f in enumerate(fh.srtFiles):